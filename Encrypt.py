@@ -1,7 +1,110 @@
 import string
 import random
 import primes
+import groups
+import entropy
 import os
+import re
+import functools
+import itertools
+import threading
+import hashlib
+import mmap
+import array
+import time
+import concurrent.futures
+from multiprocessing import shared_memory
+import metrics
+
+TABLE_CACHE_SIZE = 512 #number of (charRange, key) table sets kept before evicting
+PARALLEL_THRESHOLD = 8 << 20 #encryptParallel inputs smaller than this stay in one process
+PARALLEL_MIN_CHUNK = 1 << 20 #smallest piece handed to a worker
+
+class CaesarTables:
+    """Precomputed translation tables for one (charRange, key) pair.
+
+    Built by translationTables, which caches them so every Caesar with the
+    same settings shares one copy.
+
+    Attributes:
+        encryptStr(dict): Table for str.translate that encrypts.
+        decryptStr(dict): Table for str.translate that decrypts.
+        encryptBytes(bytes): Table for bytes.translate that encrypts, or None
+            if charRange does not fit in a byte.
+        decryptBytes(bytes): Table for bytes.translate that decrypts, or None
+            if charRange does not fit in a byte.
+        outOfRangeStr(regex): Matches any str character outside of charRange.
+        outOfRangeBytes(regex): Matches any byte outside of charRange.
+
+    """
+    def __init__(self, charRange, shift):
+        """Builds the tables.
+
+        Args:
+            charRange(tuple of 2 ints): Inclusive range of valid characters.
+            shift(int): Caesar key, already reduced modulo the range size.
+
+        """
+        low, high = charRange
+        size = high - low + 1
+        codes = range(low, high+1)
+        encrypted = [(c - low + shift) % size + low for c in codes]
+        self.encryptStr = dict(zip(codes, map(chr, encrypted)))
+        self.decryptStr = dict(zip(encrypted, map(chr, codes)))
+        self.outOfRangeStr = re.compile("[^" + re.escape(chr(low)) + "-" + re.escape(chr(high)) + "]")
+        if high <= 255:
+            encTable = bytearray(range(256))
+            decTable = bytearray(range(256))
+            for c, e in zip(codes, encrypted):
+                encTable[c] = e
+                decTable[e] = c
+            self.encryptBytes = bytes(encTable)
+            self.decryptBytes = bytes(decTable)
+            self.outOfRangeBytes = re.compile(b"[^" + re.escape(bytes([low])) + b"-" + re.escape(bytes([high])) + b"]")
+        else:
+            self.encryptBytes = None
+            self.decryptBytes = None
+            self.outOfRangeBytes = None
+
+@functools.lru_cache(maxsize=TABLE_CACHE_SIZE)
+def _cachedTables(low, high, shift):
+    return CaesarTables((low, high), shift)
+
+def translationTables(charRange, key):
+    """Returns the cached CaesarTables for charRange and key.
+
+    Keys that are equal modulo the size of charRange share tables. Least
+    recently used tables are evicted once TABLE_CACHE_SIZE is reached.
+
+    Args:
+        charRange(tuple of 2 ints): Inclusive range of valid characters.
+        key(int): Caesar cipher key
+
+    Returns:
+        A CaesarTables for these settings.
+    """
+    low, high = charRange
+    return _cachedTables(low, high, key % (high - low + 1))
+
+def _selectTable(charRange, key, inputStr, decrypt, checkRange):
+    """Returns the translation table for key that processes inputStr, see Caesar._table"""
+    tables = translationTables(charRange, key)
+    if isinstance(inputStr, str):
+        outOfRange = tables.outOfRangeStr
+        table = tables.decryptStr if decrypt else tables.encryptStr
+    else:
+        if tables.encryptBytes is None:
+            raise ValueError("bytes input needs a charRange within 0-255, not " + str(charRange))
+        outOfRange = tables.outOfRangeBytes
+        table = tables.decryptBytes if decrypt else tables.encryptBytes
+    if checkRange:
+        badChar = outOfRange.search(inputStr)
+        if badChar is not None:
+            c = badChar.group()
+            if not isinstance(c, str):
+                c = chr(c[0])
+            raise ValueError(c + " is out of range: " +str(charRange))
+    return table
 
 class Caesar:
     """Holds settings for parameters of Caesar Cipher.
@@ -17,6 +120,8 @@ class Caesar:
         key(int): Caesar cipher key
 
     """
+    __slots__ = ("charRange", "key", "exceptOutOfRange")
+
     def __init__(self, charRange, key, exceptOutOfRange):
         """Creates Caesar object which will encrypt/decrypt Caesar cipher
 
@@ -33,36 +138,50 @@ class Caesar:
         self.charRange = charRange
         self.key = key
         self.exceptOutOfRange = exceptOutOfRange
-    def encrypt (self, inputStr, decrypt=False):
+    def encrypt (self, inputStr, decrypt=False, keyOffset=0):
         """Processes a string with the Caesar cipher settings.
 
         If self.exceptOutOfRange is false, out of range characters will be
         left as they are. If it true, a ValueError will be raised at any
         out of range characters.
 
+        Translation tables for the key are built once and cached (see
+        translationTables), so the whole input is processed in one pass.
+
         Args:
-            inputStr(str): String to be encrypted with Caesar Cipher
+            inputStr(str or bytes): String to be encrypted with Caesar Cipher.
+                bytes are processed byte by byte and need a charRange within
+                0-255.
             decyrpt(bool): If true, it will reverse the encryption. Default is false
+            keyOffset(int): Ignored, a Caesar key has no phase. Accepted so
+                Caesar and Vigenere can be used interchangeably.
         Returns:
-            String that is inputStr encrypted with Caesar cipher.
+            String that is inputStr encrypted with Caesar cipher. bytes input
+            gives bytes of the same type back.
 
         Raises:
             ValueError: If self.exceptOutOfRange is true and an invalid character is encountered.
 
         """
-        output = ""
-        keyVal = self.key if not decrypt else self.key*-1 
-        for c in inputStr:
-            if self.isInRange(c):
-                intVal = ord(c)
-                normalizedNew = (intVal - self.charRange[0] + keyVal) %(self.charRange[1]-self.charRange[0]+1) #since we're %ing over an exclusive range we have to add 1 so 0 will happen
-                output+= chr(normalizedNew +self.charRange[0])
-            else:
-                if self.exceptOutOfRange:
-                    raise ValueError(c + " is out of range: " +str(self.charRange))
-                else:
-                    output += c
+        if not metrics.enabled:
+            return inputStr.translate(self._table(inputStr, decrypt, self.exceptOutOfRange))
+        start = time.perf_counter()
+        output = inputStr.translate(self._table(inputStr, decrypt, self.exceptOutOfRange))
+        metrics.observe("caesar.decrypt" if decrypt else "caesar.encrypt", time.perf_counter() - start)
         return output
+
+    def _table(self, inputStr, decrypt, checkRange):
+        """Returns the translation table that processes inputStr.
+
+        Args:
+            inputStr(str or bytes): Input that the table will be used on.
+            decyrpt(bool): If true, returns the decryption table.
+            checkRange(bool): If true, raises ValueError when inputStr has a
+                character outside of charRange.
+
+        """
+        return _selectTable(self.charRange, self.key, inputStr, decrypt, checkRange)
+
     def isInRange(self,c):
         """Returns whether c is in the inclusive charRange
 
@@ -79,6 +198,37 @@ class Caesar:
         """Convenience method that does the same thing as encrypt(inputStr,true"""
         return self.encrypt(inputStr,True)
 
+    def encryptInto(self, buffer, decrypt=False, keyOffset=0):
+        """Encrypts a writable bytes-like object in place.
+
+        Same as encrypt on bytes, but the result is written back into
+        buffer, e.g. a frame's payload in a socket buffer. Nothing is
+        changed if a ValueError is raised.
+
+        Args:
+            buffer(bytearray or memoryview): Bytes to encrypt. Needs a
+                charRange within 0-255.
+            decyrpt(bool): If true, it will reverse the encryption. Default is false
+            keyOffset(int): Ignored, see encrypt.
+        Returns:
+            buffer
+
+        Raises:
+            ValueError: If self.exceptOutOfRange is true and an invalid character is encountered.
+
+        """
+        start = time.perf_counter() if metrics.enabled else None
+        with memoryview(buffer) as view:
+            table = self._table(view, decrypt, self.exceptOutOfRange)
+            view[:] = bytes(view).translate(table)
+        if start is not None:
+            metrics.observe("caesar.decrypt" if decrypt else "caesar.encrypt", time.perf_counter() - start)
+        return buffer
+
+    def decryptInto(self, buffer):
+        """Convenience method that does the same thing as encryptInto(buffer, True)"""
+        return self.encryptInto(buffer, True)
+
 class Vigenere:
     """Holds settings for parameters of Vigenere Cipher.
 
@@ -90,9 +240,12 @@ class Vigenere:
         exceptOutOfRange(bool): If true, will raise value error when
             processing input character out of range. Else will just return the
             char.
-        key(string): Vigenere cipher key
+        keyCodes(bytes-like): Character code of each key character, one
+            byte each when they fit. A mmap for keys loaded with fromFile.
+        keyPath(str): File the key was loaded from, or None
 
     """
+    __slots__ = ("charRange", "keyCodes", "keyPath", "exceptOutOfRange")
 
     def __init__(self, charRange, key, exceptOutOfRange):
         """Creates Caesar object which will encrypt/decrypt Caesar cipher
@@ -103,27 +256,79 @@ class Vigenere:
             exceptOutOfRange(bool): If true, will raise value error when
             processing input character out of range. Else will just return the
             char.
-            key(string): Vigenere cipher key
+            key(string or bytes-like): Vigenere cipher key. Each byte of a
+                bytes-like key is used as a character code.
 
+        Raises:
+            ValueError: If key is empty.
         """
-
+        if len(key) == 0:
+            raise ValueError("Vigenere key must not be empty")
         self.charRange = charRange
-        self.key = key
         self.exceptOutOfRange = exceptOutOfRange
-        self.caesarProcessors = []
-        for idx,c in enumerate(key):
-            self.caesarProcessors.append(Caesar(charRange, ord(key[idx]), exceptOutOfRange))
+        self.keyPath = None
+        if isinstance(key, str):
+            try:
+                key = key.encode("latin-1")
+            except UnicodeEncodeError:
+                key = array.array("I", map(ord, key))
+        self.keyCodes = key
+
+    @classmethod
+    def fromFile(cls, charRange, path, exceptOutOfRange):
+        """Creates a Vigenere whose key is the contents of a file.
+
+        The file is memory-mapped rather than read, so keys of any size
+        (e.g. one-time pads) cost no memory up front and only the pages
+        that get used are loaded. Each byte is a key character code, used
+        modulo the size of charRange like any other key.
+
+        Args:
+            charRange(tuple of 2 ints): see __init__
+            path(str): Key file, must not be empty
+            exceptOutOfRange(bool): see __init__
 
-    def encrypt(self, inputStr, decrypt=False):
+        """
+        with open(path, "rb") as f:
+            keyCodes = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        cipher = cls(charRange, keyCodes, exceptOutOfRange)
+        cipher.keyPath = path
+        return cipher
+
+    @property
+    def key(self):
+        """The key as a string"""
+        if isinstance(self.keyCodes, array.array):
+            return "".join(map(chr, self.keyCodes))
+        return bytes(self.keyCodes).decode("latin-1")
+
+    def close(self):
+        """Unmaps the key file of a Vigenere made with fromFile"""
+        if isinstance(self.keyCodes, mmap.mmap):
+            self.keyCodes.close()
+
+    def _table(self, position, inputStr, decrypt, checkRange=False):
+        """Returns the translation table of key position, see Caesar._table"""
+        return _selectTable(self.charRange, self.keyCodes[position], inputStr, decrypt, checkRange)
+
+    def encrypt(self, inputStr, decrypt=False, keyOffset=0):
         """Processes a string with the Vigenere cipher settings.
 
         If self.exceptOutOfRange is false, out of range characters will be
         left as they are. If it true, a ValueError will be raised at any
         out of range characters.
 
+        Every key position handles the characters inputStr[j::len(key)] with
+        one translate call, and the results are interleaved back together.
+
         Args:
-            inputStr(str): String to be encrypted with Vigenere Cipher
+            inputStr(str or bytes): String to be encrypted with Vigenere
+                Cipher. bytes need a charRange within 0-255.
             decyrpt(bool): If true, it will reverse the encryption. Default is false
+            keyOffset(int): Index of the key character used for the first
+                character of inputStr. Lets input be processed in pieces:
+                encrypting a piece with keyOffset equal to the number of
+                characters before it gives the same result as one call.
         Returns:
             String that is inputStr encrypted with Vigenere cipher.
 
@@ -131,14 +336,211 @@ class Vigenere:
             ValueError: If self.exceptOutOfRange is true and an invalid character is encountered.
 
         """
-
-        output = ""
-        for idx,c in enumerate(inputStr):
-            output += self.caesarProcessors[idx%len(self.caesarProcessors)].encrypt(c,decrypt)
+        if not metrics.enabled:
+            return self._process(inputStr, decrypt, keyOffset)
+        start = time.perf_counter()
+        output = self._process(inputStr, decrypt, keyOffset)
+        metrics.observe("vigenere.decrypt" if decrypt else "vigenere.encrypt", time.perf_counter() - start)
         return output
+
+    def _process(self, inputStr, decrypt, keyOffset):
+        """Does the work of encrypt, which adds timing when metrics are enabled"""
+        keyLen = len(self.keyCodes)
+        if len(inputStr) == 0:
+            return inputStr[:0]
+        if self.exceptOutOfRange:
+            self._table(0, inputStr, decrypt, True)
+        if keyLen == 1 or len(inputStr) == 1:
+            #a single key position needs no slicing or interleaving
+            return inputStr.translate(self._table(keyOffset % keyLen, inputStr, decrypt))
+        parts = [inputStr[j::keyLen].translate(self._table((j + keyOffset) % keyLen, inputStr, decrypt))
+                 for j in range(min(keyLen, len(inputStr)))]
+        if isinstance(inputStr, str):
+            return "".join(itertools.chain.from_iterable(itertools.zip_longest(*parts, fillvalue="")))
+        output = bytearray(len(inputStr))
+        for j, part in enumerate(parts):
+            output[j::keyLen] = part
+        return output if isinstance(inputStr, bytearray) else bytes(output)
+
+    def encryptInto(self, buffer, decrypt=False, keyOffset=0):
+        """Encrypts a writable bytes-like object in place.
+
+        Same as encrypt on bytes, but the result is written back into
+        buffer, e.g. a frame's payload in a socket buffer. Each key position
+        translates its strided slice of buffer and writes it straight back,
+        so no interleaving is needed. Nothing is changed if a ValueError is
+        raised.
+
+        Args:
+            buffer(bytearray or memoryview): Bytes to encrypt. Needs a
+                charRange within 0-255.
+            decyrpt(bool): If true, it will reverse the encryption. Default is false
+            keyOffset(int): Index of the key character used for the first
+                byte of buffer, see encrypt.
+        Returns:
+            buffer
+
+        Raises:
+            ValueError: If self.exceptOutOfRange is true and an invalid character is encountered.
+
+        """
+        start = time.perf_counter() if metrics.enabled else None
+        keyLen = len(self.keyCodes)
+        with memoryview(buffer) as view:
+            if self.exceptOutOfRange:
+                self._table(0, view, decrypt, True)
+            if keyLen == 1:
+                view[:] = bytes(view).translate(self._table(0, view, decrypt))
+            else:
+                for j in range(min(keyLen, len(view))):
+                    table = self._table((j + keyOffset) % keyLen, view, decrypt)
+                    view[j::keyLen] = bytes(view[j::keyLen]).translate(table)
+        if start is not None:
+            metrics.observe("vigenere.decrypt" if decrypt else "vigenere.encrypt", time.perf_counter() - start)
+        return buffer
+
+    def decryptInto(self, buffer, keyOffset=0):
+        """Convenience method that does the same thing as encryptInto(buffer, True, keyOffset)"""
+        return self.encryptInto(buffer, True, keyOffset)
+
+    def encryptParallel(self, data, decrypt=False, workers=None, executor=None):
+        """Encrypts a large bytes-like input across several processes.
+
+        The input is copied once into shared memory and split into chunks.
+        Each worker encrypts its chunk in place, starting at the key phase
+        of its offset, so no chunk is pickled or joined back together.
+        Inputs under PARALLEL_THRESHOLD, str inputs and a single worker are
+        handled by encrypt in this process. Should be called from under an
+        if __name__ == "__main__" guard on platforms that spawn processes.
+
+        Args:
+            data(bytes-like): Input to encrypt. Needs a charRange within 0-255.
+            decrypt(bool, optional): If true, it will reverse the encryption.
+            workers(int, optional): Number of processes. Defaults to the
+                number of cores.
+            executor(ProcessPoolExecutor, optional): Pool to reuse across
+                calls. One is created for this call if not given.
+
+        Returns:
+            The result as bytes, or as a bytearray for bytearray input.
+
+        Raises:
+            ValueError: If self.exceptOutOfRange is true and an invalid character is encountered.
+        """
+        workers = workers or os.cpu_count() or 1
+        if isinstance(data, str) or len(data) < PARALLEL_THRESHOLD or (workers == 1 and executor is None):
+            return self.encrypt(data, decrypt)
+        size = len(data)
+        #a few chunks per worker so an early finisher picks up more work
+        chunkSize = max(PARALLEL_MIN_CHUNK, -(-size//(workers*4)))
+        shm = shared_memory.SharedMemory(create=True, size=size)
+        ownExecutor = executor is None
+        if ownExecutor:
+            executor = concurrent.futures.ProcessPoolExecutor(workers)
+        try:
+            shm.buf[:size] = data
+            futures = [executor.submit(_vigenereChunk, shm.name, start, min(start + chunkSize, size),
+                                       self.charRange, None if self.keyPath else self.keyCodes, self.keyPath,
+                                       self.exceptOutOfRange, decrypt)
+                       for start in range(0, size, chunkSize)]
+            for future in futures:
+                future.result()
+            output = shm.buf[:size]
+            try:
+                return bytearray(output) if isinstance(data, bytearray) else bytes(output)
+            finally:
+                output.release()
+        finally:
+            if ownExecutor:
+                executor.shutdown(cancel_futures=True)
+            shm.close()
+            shm.unlink()
+
     def decrypt(self, inputStr):
         """Convenience method that does the same thing as encrypt(inputStr,true"""
         return self.encrypt(inputStr,True)
+
+def _vigenereChunk(shmName, start, end, charRange, keyCodes, keyPath, exceptOutOfRange, decrypt):
+    """Encrypts bytes start:end of a shared memory block in place. Runs in an encryptParallel worker
+
+    The key is given as keyCodes, or as keyPath for file-backed keys so the
+    worker maps the file itself instead of receiving a pickled copy.
+    """
+    shm = shared_memory.SharedMemory(name=shmName)
+    cipher = Vigenere.fromFile(charRange, keyPath, exceptOutOfRange) if keyPath else Vigenere(charRange, keyCodes, exceptOutOfRange)
+    try:
+        with shm.buf[start:end] as view:
+            cipher.encryptInto(view, decrypt, start)
+    finally:
+        cipher.close()
+        shm.close()
+
+def batchVigenere(charRange, messages, keys, exceptOutOfRange, decrypt=False):
+    """Encrypts many messages at once, each with its own Vigenere key.
+
+    Gives the same results as Vigenere(charRange, key,
+    exceptOutOfRange).encrypt(message, decrypt) for every message/key pair,
+    but all of the shifting is done as NumPy array operations over the
+    concatenated messages. Requires NumPy.
+
+    Args:
+        charRange(tuple of 2 ints): Integer tuple which describes the
+            ascii start and end of valid characters for input/output.
+        messages(list of str): Messages to be processed.
+        keys(str or list of str): One key per message, or a single key used
+            for all of them.
+        exceptOutOfRange(bool): If true, will raise value error when
+            processing input character out of range. Else will just return the
+            char.
+        decrypt(bool): If true, it will reverse the encryption. Default is false
+
+    Returns:
+        List of processed strings, in the same order as messages.
+
+    Raises:
+        ValueError: If exceptOutOfRange is true and an invalid character is
+            encountered, if a key is empty or if there is not one key per
+            message.
+        ImportError: If NumPy is not installed.
+
+    """
+    import numpy
+
+    if isinstance(keys, str):
+        keys = [keys]*len(messages)
+    if len(keys) != len(messages):
+        raise ValueError("Need one key per message, got " + str(len(keys)) + " keys for " + str(len(messages)) + " messages")
+    if len(messages) == 0:
+        return []
+    if not all(keys):
+        raise ValueError("Vigenere keys must not be empty")
+
+    low, high = charRange
+    size = high - low + 1
+    msgLens = numpy.fromiter(map(len, messages), dtype=numpy.int64, count=len(messages))
+    keyLens = numpy.fromiter(map(len, keys), dtype=numpy.int64, count=len(keys))
+    text = numpy.frombuffer("".join(messages).encode("utf-32-le"), dtype=numpy.uint32).astype(numpy.int64)
+    keyVals = numpy.frombuffer("".join(keys).encode("utf-32-le"), dtype=numpy.uint32).astype(numpy.int64)
+
+    inRange = (text >= low) & (text <= high)
+    if exceptOutOfRange and not inRange.all():
+        c = chr(text[numpy.argmin(inRange)])
+        raise ValueError(c + " is out of range: " +str(charRange))
+
+    #position of each character within its own message, used to pick the
+    #key character as keyStart + position % keyLen
+    msgStarts = numpy.cumsum(msgLens) - msgLens
+    keyStarts = numpy.cumsum(keyLens) - keyLens
+    positions = numpy.arange(len(text), dtype=numpy.int64) - numpy.repeat(msgStarts, msgLens)
+    shifts = keyVals[numpy.repeat(keyStarts, msgLens) + positions % numpy.repeat(keyLens, msgLens)]
+    if decrypt:
+        shifts = -shifts
+    shifted = (text - low + shifts) % size + low
+    output = numpy.where(inRange, shifted, text).astype(numpy.uint32).tobytes().decode("utf-32-le")
+
+    ends = numpy.cumsum(msgLens).tolist()
+    return [output[start:end] for start, end in zip([0] + ends[:-1], ends)]
+
 ##test = Caesar((33,78),1,False)
 ##
 ####print(test.isInRange("A"))
@@ -159,24 +561,88 @@ class Vigenere:
 ##print("Test passed" if decrypted==origStr else "TEST FAILED")
 
 def isPrimitiveRoot(g, n):
-    modResults = set()
-    for i in range(1,n):
-        modResults.add((g**i)%n)
-        if len(modResults) == n-1:
-            return True
-    return False
+    """Checks that g is a primitive root of n. Same as primes.isPrimitiveRoot"""
+    return primes.isPrimitiveRoot(g, n)
 
 ##print(isPrimitiveRoot(5,23))
 ##print(isPrimitiveRoot(2,4))
 ##print(isPrimitiveRoot(3,11))
 
+FIXED_BASE_WINDOW = 4 #bits of the exponent handled by each table row
+FIXED_BASE_CACHE_SIZE = 16 #number of (g, n) tables kept before evicting
+
+class FixedBaseTable:
+    """Precomputed powers of a fixed base for fast g**e % n.
+
+    Row i holds g**(d * 2**(window*i)) % n for every window-bit digit d, so
+    g**e % n only needs one multiplication per non-zero digit of e. Rows are
+    added as larger exponents show up and are shared between threads.
+
+    Attributes:
+        g(int): The base
+        n(int): The modulus
+        window(int): Bits of the exponent covered by each row
+
+    """
+    def __init__(self, g, n, window=FIXED_BASE_WINDOW):
+        """Creates an empty table.
+
+        Args:
+            g(int): The base
+            n(int): The modulus
+            window(int, optional): Bits of the exponent covered by each row
+
+        """
+        self.g = g
+        self.n = n
+        self.window = window
+        self._rows = []
+        self._lock = threading.Lock()
+
+    def _grow(self, rowCount):
+        """Adds rows until there are at least rowCount"""
+        with self._lock:
+            while len(self._rows) < rowCount:
+                if self._rows:
+                    base = pow(self._rows[-1][1], 1 << self.window, self.n)
+                else:
+                    base = self.g % self.n
+                row = [1, base]
+                for d in range(2, 1 << self.window):
+                    row.append(row[-1]*base % self.n)
+                self._rows.append(row)
+
+    def pow(self, exponent):
+        """Returns g**exponent % n"""
+        if exponent < 0:
+            return pow(self.g, exponent, self.n)
+        rowCount = (exponent.bit_length() + self.window - 1)//self.window
+        if rowCount > len(self._rows):
+            self._grow(rowCount)
+        mask = (1 << self.window) - 1
+        result = 1
+        for row in self._rows:
+            if not exponent:
+                break
+            digit = exponent & mask
+            if digit:
+                result = result*row[digit] % self.n
+            exponent >>= self.window
+        return result % self.n
+
+@functools.lru_cache(maxsize=FIXED_BASE_CACHE_SIZE)
+def fixedBaseTable(g, n):
+    """Returns the shared FixedBaseTable for g and n, creating it if needed"""
+    return FixedBaseTable(g, n)
+
 
 class Locksmith: 
     """
     Generates keys for Diffie-Hellman. Vulnerable to man-in-the-middle attacks.
 
     Generates keys based on g and n. Can generate secret value or work with
-    passed in value. g should be a primitive root of n
+    passed in value. g should be a primitive root of n, which is checked once
+    per group and remembered by the groups registry.
     In order to discourage key re-use (because the same session key will
     result each time) the intermediate values and keys can only be calculated
     once. You should create a new secret for each communication.
@@ -187,7 +653,7 @@ class Locksmith:
       randNum (int) The secret
 
     """
-    def __init__(self,g,n,randNum):
+    def __init__(self,g,n,randNum, precompute=False):
         """
         Initializes the Locksmith. 
 
@@ -195,18 +661,29 @@ class Locksmith:
             g(int): A primitive root of n 
             n(int): A prime number
             randNum(int): the secret 
+            precompute(bool, optional): If true, powers of g are taken from a
+                FixedBaseTable shared by every Locksmith using this (g, n).
+                Worth it when many handshakes use the same group.
           
         """
         if randNum == None:
             raise NotImplemented()
             
         self.randNum = randNum
-        if not primes.isPrimitiveRoot(g, n):
+        if not groups.isValidGroup(g, n):
             raise ValueError(str(g) + "is not a primitive root of "+str(n))
         self.g = g
         self.n = n
+        self.fixedBase = fixedBaseTable(g, n) if precompute else None
         self.intermValCalced = False
         self.keyCalced = False
+
+    def _powG(self, exponent):
+        """Returns g**exponent % n, using the fixed base table if there is one"""
+        if self.fixedBase is not None:
+            return self.fixedBase.pow(exponent)
+        return pow(self.g, exponent, self.n)
+
     #CHECK THAT THIS WOULD BE A SECUIRITY PROBLEM FOR REPEAT..
     def makeIntermediateVal(self):
         """Makes the intermediate value/public key to send to other party
@@ -219,7 +696,7 @@ class Locksmith:
         if self.intermValCalced:
             raise ValueError("Intermediate Value should only be calculated once.")
         self.intermValCalced = True 
-        return (self.g**self.randNum)%self.n
+        return self._powG(self.randNum)
     
     def makeKey(self, otherContribution):
         """Creates a session key using secret and contribution from other party.
@@ -235,7 +712,7 @@ class Locksmith:
         if self.keyCalced:
             raise ValueError("Key should only be calculated once.")
         self.keyCalced = True
-        return (otherContribution**self.randNum) % self.n
+        return pow(otherContribution, self.randNum, self.n)
 
 class VigLocksmith(Locksmith):
     """"Geneterates a sequence of numbers from diffe-hellman to come up with a Vigenere Cipher Key
@@ -244,7 +721,7 @@ class VigLocksmith(Locksmith):
 
     """
 
-    def __init__(self, g, n, initialValue):
+    def __init__(self, g, n, initialValue, precompute=False):
         """
         Initializes the Vigenere Locksmith. 
 
@@ -252,13 +729,21 @@ class VigLocksmith(Locksmith):
             g(int): A primitive root of n 
             n(int): A prime number
             randNum(int): List of secret nums. Length of randomNums must be same for both parties
-          
+            precompute(bool, optional): If true, powers of g are taken from a
+                shared FixedBaseTable (see Locksmith).
+
+        Raises:
+            ValueError: If g is not a primitive root of n or initialValue is
+                empty, which would give an empty key.
         """
-        if not primes.isPrimitiveRoot(g, n):
+        if not groups.isValidGroup(g, n):
             raise ValueError(str(g) + "is not a primitive root of "+str(n))
+        if len(initialValue) == 0:
+            raise ValueError("VigLocksmith secret must not be empty")
         self.g =g
         self.n = n
         self.initialValue = initialValue
+        self.fixedBase = fixedBaseTable(g, n) if precompute else None
         self.intermValCalced = False
         self.keyCalced = False
 
@@ -273,7 +758,7 @@ class VigLocksmith(Locksmith):
         if self.intermValCalced:
             raise ValueError("Intermediate Value should only be calculated once.")
         self.intermValCalced = True 
-        return VigLocksmith.numsToKey([(self.g**randNum)%self.n for randNum in VigLocksmith.keyToNums(self.initialValue, 64)],64)
+        return VigLocksmith.numsToKey([self._powG(randNum) for randNum in VigLocksmith.keyToNums(self.initialValue, 64)],64)
 
     def makeKey(self, otherContribution):
         """Creates a session key using secret list and contribution list from other party.
@@ -292,7 +777,7 @@ class VigLocksmith(Locksmith):
         if self.keyCalced:
             raise ValueError("Key should only be calculated once.")
         self.keyCalced = True
-        asNums = [(pair[1]**pair[0]) % self.n for pair in zip(VigLocksmith.keyToNums(self.initialValue,64), VigLocksmith.keyToNums(otherContribution,64))]
+        asNums = [pow(pair[1], pair[0], self.n) for pair in zip(VigLocksmith.keyToNums(self.initialValue,64), VigLocksmith.keyToNums(otherContribution,64))]
         return "".join(map(convert,asNums))
 
     @staticmethod
@@ -302,17 +787,96 @@ class VigLocksmith(Locksmith):
     
     @staticmethod
     def numsToKey(nums, offset):
-        print("RECEIVED " + str(nums))
         converter = lambda i: chr(i + offset)
         return "".join(list(map(converter,nums)))
 
+class ExpandingVigLocksmith(Locksmith):
+    """Makes a Vigenere key of any length from a single Diffie-Hellman exchange.
+
+    Unlike VigLocksmith, which does one exchange per key character, both
+    parties exchange one intermediate value and the shared secret is
+    stretched into the key with expandKey. A long key costs the same single
+    exponentiation as a short one.
+
+    Attributes:
+      g (int) A primitive root of n
+      n (int) A prime number
+      randNum (int) The secret
+      keyLength (int) Length of the key made by makeKey
+
+    """
+    def __init__(self, g, n, randNum, keyLength, precompute=False):
+        """
+        Initializes the Expanding Vigenere Locksmith.
+
+        Args:
+            g(int): A primitive root of n
+            n(int): A prime number
+            randNum(int): the secret
+            keyLength(int): Length of the key. Must be the same for both parties
+            precompute(bool, optional): If true, powers of g are taken from a
+                shared FixedBaseTable (see Locksmith).
+
+        """
+        Locksmith.__init__(self, g, n, randNum, precompute)
+        self.keyLength = keyLength
+
+    def makeIntermediateVal(self):
+        """Makes the intermediate value/public key to send to other party
+
+        To discourage session key re-use, may only be called once.
+
+        Returns:
+          The intermediate value as a string of decimal digits
+        """
+        return str(Locksmith.makeIntermediateVal(self))
+
+    def makeKey(self, otherContribution):
+        """Creates a session key using secret and contribution from other party.
+
+        To discourage session key re-use, may only be called once.
+
+        Args:
+          otherContribution(string or int): The other party's intermediate value
+
+        Returns:
+          The session key as a string of keyLength characters.
+        """
+        return expandKey(Locksmith.makeKey(self, int(otherContribution)), self.keyLength)
+
+def expandKey(sharedSecret, length, charRange=(65,122), context=b""):
+    """Deterministically stretches a shared secret into a Vigenere key.
+
+    SHAKE-256 output over the secret is mapped into charRange by rejection
+    sampling, so every character in the range is equally likely.
+
+    Args:
+        sharedSecret(int or bytes): Secret both parties know
+        length(int): Length of the key
+        charRange(tuple of 2 ints, optional): Inclusive range of key
+            characters, within 0-255. Default is A to z like VigLocksmith
+        context(bytes, optional): Mixed into the hash so different uses of one
+            secret give unrelated keys.
+
+    Returns:
+        A key string of the requested length.
+    """
+    if isinstance(sharedSecret, int):
+        sharedSecret = sharedSecret.to_bytes((sharedSecret.bit_length() + 7)//8 or 1, "big")
+    table, rejected = entropy.samplingTable(tuple(charRange))
+    shake = hashlib.shake_256(len(context).to_bytes(4, "big") + context + sharedSecret)
+    numBytes = length + length//4 + 16
+    while True:
+        key = shake.digest(numBytes).translate(table, rejected)
+        if len(key) >= length:
+            return key[:length].decode("latin-1")
+        numBytes *= 2
+
 def genVigKey(length):
     """Generates a random key of upper and lowercase letters of the specified length"""
-    #os.urnandom is generated by OS and supposed to be more random
-    #4.48 comes from 255/57 rounded up slightly for safety
     #65 is where A starts, there is a bit of punctuation in betwen
-    #122 is z 122 - 65 = 57
-    return "".join([chr(int(ord(os.urandom(1))/4.48) +65) for i in range(0,length)])
+    #122 is z. Every character from A to z is equally likely
+    return entropy.randomString(length, (65,122))
         
 if __name__=="__main__":
     alice = Locksmith(5,23,6)
@@ -0,0 +1,260 @@
+import argparse
+import sys
+import numpy
+import Encrypt
+
+"""Cryptanalysis of Caesar and Vigenere ciphertext, for auditing our traffic
+
+Everything is done with NumPy array operations over the character codes, so
+megabytes of ciphertext are analysed in seconds. Requires NumPy.
+
+Characters outside of charRange are left alone by the ciphers and are
+ignored here, but they still move the Vigenere key along, so positions
+always count every character. Plaintext statistics come from a reference
+distribution over charRange, English text by default (see
+englishReference).
+
+    python analysis.py captured.txt
+"""
+
+#percent of letters in English text
+ENGLISH_LETTER_FREQUENCIES = {
+    "a": 8.17, "b": 1.49, "c": 2.78, "d": 4.25, "e": 12.70, "f": 2.23, "g": 2.02,
+    "h": 6.09, "i": 6.97, "j": 0.15, "k": 0.77, "l": 4.03, "m": 2.41, "n": 6.75,
+    "o": 7.51, "p": 1.93, "q": 0.10, "r": 5.99, "s": 6.33, "t": 9.06, "u": 2.76,
+    "v": 0.98, "w": 2.36, "x": 0.15, "y": 1.97, "z": 0.07}
+UPPER_CASE_SHARE = 0.05 #fraction of letters assumed to be upper case
+UNSEEN_WEIGHT = 1e-4 #weight of in-range characters that are not letters
+DEFAULT_MAX_PERIOD = 64
+KASISKI_MAX_DISTANCES = 200000 #repeat distances sampled by kasiskiScores
+
+def englishReference(charRange=(65,122)):
+    """Returns the distribution of English plaintext over charRange
+
+    Args:
+        charRange(tuple of 2 ints): Inclusive range of cipher characters
+
+    Returns:
+        Float array of length high-low+1 summing to 1, element i being the
+        probability of character low+i.
+    """
+    low, high = charRange
+    weights = numpy.full(high - low + 1, UNSEEN_WEIGHT)
+    for letter, percent in ENGLISH_LETTER_FREQUENCIES.items():
+        for c, share in ((letter, 1 - UPPER_CASE_SHARE), (letter.upper(), UPPER_CASE_SHARE)):
+            if low <= ord(c) <= high:
+                weights[ord(c) - low] += percent*share
+    return weights/weights.sum()
+
+def toCodes(text):
+    """Returns the character codes of a str or bytes-like object as an int64 array"""
+    if isinstance(text, str):
+        return numpy.frombuffer(text.encode("utf-32-le"), dtype=numpy.uint32).astype(numpy.int64)
+    return numpy.frombuffer(text, dtype=numpy.uint8).astype(numpy.int64)
+
+def _symbols(text, charRange):
+    """Returns (positions, symbols) of the in-range characters of text
+
+    Symbols are codes relative to the bottom of charRange, 0 to size-1.
+    """
+    low, high = charRange
+    codes = toCodes(text)
+    positions = numpy.flatnonzero((codes >= low) & (codes <= high))
+    return positions, codes[positions] - low
+
+def frequencies(text, charRange=(65,122)):
+    """Counts each character of charRange in text
+
+    Returns:
+        Int array of length high-low+1, element i counting character low+i.
+    """
+    positions, symbols = _symbols(text, charRange)
+    return numpy.bincount(symbols, minlength=charRange[1] - charRange[0] + 1)
+
+def _shiftScores(counts, reference):
+    """Log likelihood of every Caesar shift, for each row of counts
+
+    Args:
+        counts(array): (..., size) character counts of ciphertext
+        reference(array): Plaintext distribution of length size
+
+    Returns:
+        (..., size) array, element k scoring the plaintext given by shifting
+        back by k.
+    """
+    size = len(reference)
+    #row k of shifted lists the ciphertext symbol each plaintext symbol
+    #becomes under shift k, so counts[..., shifted] undoes shift k
+    shifted = (numpy.arange(size)[None, :] + numpy.arange(size)[:, None]) % size
+    return counts[..., shifted] @ numpy.log(reference)
+
+def caesarScores(ciphertexts, charRange=(65,122), reference=None):
+    """Scores every Caesar key for a batch of ciphertexts at once
+
+    Args:
+        ciphertexts(list of str or bytes): Messages, each with its own key
+        charRange(tuple of 2 ints, optional): Range of cipher characters
+        reference(array, optional): Plaintext distribution, English by default
+
+    Returns:
+        (len(ciphertexts), size) array. Higher is more likely. Column k is
+        the key k, and every key equal to k modulo the size of charRange.
+    """
+    if reference is None:
+        reference = englishReference(charRange)
+    counts = numpy.array([frequencies(c, charRange) for c in ciphertexts]).reshape(len(ciphertexts), len(reference))
+    return _shiftScores(counts, reference)
+
+def breakCaesar(ciphertexts, charRange=(65,122), reference=None):
+    """Finds the most likely Caesar key of each ciphertext
+
+    Returns:
+        List of keys, each between 0 and high-low.
+    """
+    return caesarScores(ciphertexts, charRange, reference).argmax(axis=1).tolist()
+
+def coincidenceIndices(ciphertext, charRange=(65,122), maxPeriod=DEFAULT_MAX_PERIOD):
+    """Average index of coincidence of the columns of each candidate period
+
+    For the right period (or a multiple of it) every column is one Caesar
+    shift of plaintext and its index of coincidence is that of plaintext.
+    For other periods the columns mix shifts and it drops towards
+    1/size. Each period is counted with a single bincount over all columns.
+
+    Returns:
+        Float array, element p being the index for period p. Element 0 is 0.
+    """
+    positions, symbols = _symbols(ciphertext, charRange)
+    size = charRange[1] - charRange[0] + 1
+    indices = numpy.zeros(maxPeriod + 1)
+    for period in range(1, maxPeriod + 1):
+        counts = numpy.bincount((positions % period)*size + symbols, minlength=period*size).reshape(period, size)
+        totals = counts.sum(axis=1)
+        pairs = totals*(totals - 1)
+        usable = pairs > 0
+        if usable.any():
+            indices[period] = ((counts*(counts - 1)).sum(axis=1)[usable]/pairs[usable]).mean()
+    return indices
+
+def kasiskiScores(ciphertext, charRange=(65,122), maxPeriod=DEFAULT_MAX_PERIOD, length=3):
+    """Kasiski examination for each candidate period
+
+    Repeated runs of length characters are mostly the same plaintext under
+    the same key phase, so the distances between them are multiples of the
+    key length. Runs are found by sorting their packed codes.
+
+    Returns:
+        Float array, element p being the fraction of repeat distances that p
+        divides. Element 0 is 0.
+    """
+    codes = toCodes(ciphertext)
+    scores = numpy.zeros(maxPeriod + 1)
+    if len(codes) < 2*length:
+        return scores
+    base = int(codes.max()) + 1
+    grams = numpy.zeros(len(codes) - length + 1, dtype=numpy.int64)
+    if base**length >= 1 << 62:
+        #too big to pack exactly, hash instead. A collision only adds noise
+        for i in range(length):
+            grams = grams*1000003 + codes[i:len(codes) - length + 1 + i]
+    else:
+        for i in range(length):
+            grams = grams*base + codes[i:len(codes) - length + 1 + i]
+    order = numpy.argsort(grams, kind="stable")
+    repeats = grams[order[1:]] == grams[order[:-1]]
+    distances = (order[1:] - order[:-1])[repeats]
+    if len(distances) == 0:
+        return scores
+    if len(distances) > KASISKI_MAX_DISTANCES:
+        distances = distances[numpy.linspace(0, len(distances) - 1, KASISKI_MAX_DISTANCES).astype(numpy.int64)]
+    periods = numpy.arange(1, maxPeriod + 1)
+    scores[1:] = (distances[:, None] % periods[None, :] == 0).mean(axis=0)
+    return scores
+
+def keyLength(ciphertext, charRange=(65,122), maxPeriod=DEFAULT_MAX_PERIOD, reference=None):
+    """Estimates the length of a Vigenere key
+
+    Picks the shortest period whose index of coincidence is close to that
+    of plaintext, so multiples of the key length are not chosen over it.
+    Kasiski scores break ties between close candidates.
+
+    Args:
+        ciphertext(str or bytes): Vigenere ciphertext
+        charRange(tuple of 2 ints, optional): Range of cipher characters
+        maxPeriod(int, optional): Longest key length considered
+        reference(array, optional): Plaintext distribution, English by default
+
+    Returns:
+        The estimated key length. 1 if no period looks like plaintext, e.g.
+        when the ciphertext is too short to tell.
+    """
+    if reference is None:
+        reference = englishReference(charRange)
+    if maxPeriod < 1:
+        return 1
+    indices = coincidenceIndices(ciphertext, charRange, maxPeriod)
+    kasiski = kasiskiScores(ciphertext, charRange, maxPeriod)
+    plaintextIndex = (reference**2).sum()
+    randomIndex = 1/len(reference)
+    #how far each period is from random text towards plaintext
+    closeness = (indices - randomIndex)/(plaintextIndex - randomIndex)
+    best = closeness[1:].max()
+    candidates = numpy.flatnonzero(closeness >= max(0.8*best, best - 0.1))
+    candidates = candidates[candidates > 0]
+    if len(candidates) == 0:
+        return 1
+    shortest = candidates[0]
+    #only multiples of the shortest candidate can be the key length as well
+    multiples = candidates[candidates % shortest == 0]
+    if kasiski[multiples].any():
+        #argmax keeps the shortest of equally scored periods
+        return int(multiples[numpy.argmax(kasiski[multiples])])
+    return int(shortest)
+
+def recoverKey(ciphertext, period, charRange=(65,122), reference=None):
+    """Recovers a Vigenere key of known length
+
+    Every key position is a Caesar cipher over its column, and all columns
+    are scored against all shifts in one matrix product.
+
+    Returns:
+        The key as a string of characters in charRange.
+    """
+    if reference is None:
+        reference = englishReference(charRange)
+    low, high = charRange
+    size = high - low + 1
+    positions, symbols = _symbols(ciphertext, charRange)
+    counts = numpy.bincount((positions % period)*size + symbols, minlength=period*size).reshape(period, size)
+    shifts = _shiftScores(counts, reference).argmax(axis=1)
+    #the key character in charRange that is congruent to each shift
+    return "".join(chr(low + (int(s) - low) % size) for s in shifts)
+
+def breakVigenere(ciphertext, charRange=(65,122), maxPeriod=DEFAULT_MAX_PERIOD, reference=None):
+    """Recovers the key of a Vigenere ciphertext and decrypts it
+
+    Returns:
+        Tuple (key, plaintext).
+    """
+    period = keyLength(ciphertext, charRange, maxPeriod, reference)
+    key = recoverKey(ciphertext, period, charRange, reference)
+    return key, Encrypt.Vigenere(charRange, key, False).decrypt(ciphertext)
+
+def main(argv=None):
+    """Breaks a captured ciphertext file from the command line"""
+    parser = argparse.ArgumentParser(description="Recover the key of Vigenere or Caesar ciphertext")
+    parser.add_argument("file", help="captured ciphertext")
+    parser.add_argument("--low", type=int, default=65, help="first character code of the cipher range")
+    parser.add_argument("--high", type=int, default=122, help="last character code of the cipher range")
+    parser.add_argument("--max-period", type=int, default=DEFAULT_MAX_PERIOD, help="longest key length considered")
+    parser.add_argument("--encoding", default="utf-8", help="text encoding of the file")
+    args = parser.parse_args(argv)
+    with open(args.file, encoding=args.encoding) as f:
+        ciphertext = f.read()
+    key, plaintext = breakVigenere(ciphertext, (args.low, args.high), args.max_period)
+    print("key length: " + str(len(key)))
+    print("key: " + key)
+    sys.stdout.write(plaintext[:1000] + "\n")
+
+if __name__ == "__main__":
+    main()
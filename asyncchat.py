@@ -0,0 +1,254 @@
+import asyncio
+import queue
+import Encrypt
+import keypool
+import framing
+import metrics
+
+"""asyncio chat server and client speaking the same protocol as startUI
+
+The connecting side sends its VigLocksmith intermediate value in a handshake
+frame, the listening side answers with its own, and from then on every chat
+frame is Vigenere encrypted with the agreed key (see framing). One event
+loop can serve thousands of peers, and startUI's Tk client can connect to
+the server like any other peer.
+"""
+
+DEFAULT_ADDRESS = ("127.0.0.1", 25123)
+CHAR_RANGE = (65,122)
+MAX_WRITE_BUFFER = 1 << 20 #peers that fall further behind than this are dropped
+
+class ChatSession:
+    """An encrypted connection to one peer.
+
+    Attributes:
+        reader(StreamReader): Incoming side of the connection.
+        writer(StreamWriter): Outgoing side of the connection.
+        encrypter(Vigenere): Cipher with the key agreed in the handshake.
+        name(str): Label for the peer, its address by default.
+
+    """
+    def __init__(self, reader, writer, encrypter, name=None):
+        """Creates a ChatSession.
+
+        Args:
+            reader(StreamReader): Incoming side of the connection.
+            writer(StreamWriter): Outgoing side of the connection.
+            encrypter(Vigenere): Cipher with the key agreed in the handshake.
+            name(str, optional): Label for the peer. Defaults to its address.
+
+        """
+        self.reader = reader
+        self.writer = writer
+        self.encrypter = encrypter
+        if name is None:
+            name = ":".join(map(str, writer.get_extra_info("peername") or ("unknown",)))
+        self.name = name
+
+    def write(self, message):
+        """Encrypts message and queues it for sending without waiting"""
+        frame = framing.frameBuffer(framing.FRAME_CHAT, bytes(message, "utf-8"))
+        with memoryview(frame) as view:
+            self.encrypter.encryptInto(view[framing.HEADER.size:])
+        self.writer.write(frame)
+
+    async def send(self, message):
+        """Encrypts message, sends it and waits until it has been handed to the OS"""
+        self.write(message)
+        await self.writer.drain()
+
+    async def receive(self):
+        """Waits for the next message from the peer.
+
+        Returns:
+            The decrypted message, or None once the peer has closed the
+            connection.
+
+        Raises:
+            ValueError: If the peer sends something other than a chat frame.
+        """
+        frame = await framing.readFrameAsync(self.reader)
+        if frame is None:
+            return None
+        frameType, payload = frame
+        if frameType != framing.FRAME_CHAT:
+            raise ValueError("Expected a chat frame, got type " + str(frameType))
+        payload = bytearray(payload)
+        return str(self.encrypter.decryptInto(payload), "utf-8")
+
+    def close(self):
+        """Closes the connection"""
+        self.writer.close()
+
+async def readHandshake(reader):
+    """Reads the other party's intermediate value from a handshake frame
+
+    Raises:
+        ValueError: If the next frame is not a handshake frame, or is empty.
+        ConnectionError: If the connection closes first.
+    """
+    return _handshakeValue(await framing.readFrameAsync(reader))
+
+def _handshakeValue(frame):
+    """Returns the intermediate value in a frame from readFrameAsync"""
+    if frame is None:
+        raise ConnectionError("Connection closed during handshake")
+    frameType, payload = frame
+    if frameType != framing.FRAME_HANDSHAKE:
+        raise ValueError("Expected a handshake frame, got type " + str(frameType))
+    if len(payload) == 0:
+        raise ValueError("Empty handshake value, it would give an empty key")
+    return str(payload, "utf-8")
+
+async def clientHandshake(reader, writer, g, n, secret):
+    """Agrees on a key as the connecting party, like Setup.connectClicked.
+
+    Args:
+        reader(StreamReader): Incoming side of the connection.
+        writer(StreamWriter): Outgoing side of the connection.
+        g(int): A primitive root of n
+        n(int): A prime number
+        secret(str): VigLocksmith secret
+
+    Returns:
+        A ChatSession with the agreed key.
+    """
+    locksmith = Encrypt.VigLocksmith(g, n, secret)
+    framing.writeFrame(writer, framing.FRAME_HANDSHAKE, bytes(locksmith.makeIntermediateVal(), "utf-8"))
+    otherKey = await readHandshake(reader)
+    return ChatSession(reader, writer, Encrypt.Vigenere(CHAR_RANGE, locksmith.makeKey(otherKey), False))
+
+async def serverHandshake(reader, writer, keyPool):
+    """Agrees on a key as the listening party, like Setup.listenForConnections.
+
+    Attempts to resume a session are refused, so a peer holding a ticket
+    falls back to a full handshake.
+
+    Args:
+        reader(StreamReader): Incoming side of the connection.
+        writer(StreamWriter): Outgoing side of the connection.
+        keyPool(KeyPool): Source of ready VigLocksmiths, so no
+            exponentiation has to happen on the event loop.
+
+    Returns:
+        A ChatSession with the agreed key.
+    """
+    try:
+        locksmith, intermediateVal = keyPool.pairs.get_nowait()
+    except queue.Empty:
+        #the pool ran dry in a burst, make a pair without blocking the loop
+        locksmith, intermediateVal = await asyncio.get_running_loop().run_in_executor(None, keyPool.take)
+    frame = await framing.readFrameAsync(reader)
+    if frame is not None and frame[0] == framing.FRAME_RESUME:
+        #the relay keeps no tickets, so refuse and wait for a full handshake
+        framing.writeFrame(writer, framing.FRAME_RESUME, b"")
+        frame = await framing.readFrameAsync(reader)
+    otherKey = _handshakeValue(frame)
+    session = ChatSession(reader, writer, Encrypt.Vigenere(CHAR_RANGE, locksmith.makeKey(otherKey), False))
+    framing.writeFrame(writer, framing.FRAME_HANDSHAKE, bytes(intermediateVal, "utf-8"))
+    await writer.drain()
+    return session
+
+class ChatServer:
+    """Chat room relaying messages between every connected peer.
+
+    Each peer has its own key, so a message is decrypted with the sender's
+    cipher and re-encrypted for every other peer.
+
+    Attributes:
+        keyPool(KeyPool): Ready locksmiths for the server's side of handshakes.
+        sessions(set of ChatSession): Peers currently connected.
+
+    """
+    def __init__(self, g=5, n=23, secretLength=5, poolSize=64):
+        """Creates a ChatServer.
+
+        Args:
+            g(int, optional): A primitive root of n
+            n(int, optional): A prime number
+            secretLength(int, optional): Length of the server's secrets. The
+                key is as long as the shorter of the two secrets.
+            poolSize(int, optional): Locksmiths kept ready for handshakes.
+
+        """
+        self.keyPool = keypool.KeyPool(g, n, poolSize, secretLength)
+        self.sessions = set()
+
+    async def handleConnection(self, reader, writer):
+        """Runs one peer from handshake to disconnect"""
+        try:
+            with metrics.timer("server.handshake"):
+                session = await serverHandshake(reader, writer, self.keyPool)
+        except (OSError, ValueError):
+            writer.close()
+            return
+        self.sessions.add(session)
+        if metrics.enabled:
+            metrics.setGauge("server.sessions", len(self.sessions))
+        try:
+            while True:
+                message = await session.receive()
+                if message is None:
+                    break
+                self.broadcast(session, session.name + ": " + message)
+                if metrics.enabled:
+                    metrics.increment("server.messagesRelayed")
+        except (OSError, ValueError):
+            pass
+        finally:
+            self.sessions.discard(session)
+            session.close()
+            if metrics.enabled:
+                metrics.setGauge("server.sessions", len(self.sessions))
+
+    def broadcast(self, sender, message):
+        """Sends message to every peer except sender.
+
+        Peers whose unsent data has grown past MAX_WRITE_BUFFER are
+        disconnected, so one slow reader cannot use up the server's memory.
+        """
+        for session in list(self.sessions):
+            if session is sender:
+                continue
+            if session.writer.transport.get_write_buffer_size() > MAX_WRITE_BUFFER:
+                self.sessions.discard(session)
+                session.close()
+                continue
+            session.write(message)
+
+    async def start(self, host, port):
+        """Starts listening and returns the asyncio Server"""
+        return await asyncio.start_server(self.handleConnection, host, port)
+
+    async def serveForever(self, host, port):
+        """Listens on host:port until cancelled"""
+        server = await self.start(host, port)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.keyPool.close()
+
+async def connect(host, port, g=5, n=23, secret=None):
+    """Connects to a peer or ChatServer and performs the handshake.
+
+    Args:
+        host(str): Address to connect to
+        port(int): Port to connect to
+        g(int, optional): A primitive root of n
+        n(int, optional): A prime number
+        secret(str, optional): VigLocksmith secret. Random if not given.
+
+    Returns:
+        A ChatSession with the agreed key.
+    """
+    if secret is None:
+        secret = Encrypt.genVigKey(5)
+    reader, writer = await asyncio.open_connection(host, port)
+    return await clientHandshake(reader, writer, g, n, secret)
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(ChatServer().serveForever(*DEFAULT_ADDRESS))
+    except KeyboardInterrupt:
+        pass
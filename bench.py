@@ -0,0 +1,205 @@
+import argparse
+import json
+import platform
+import sys
+import threading
+import time
+import Encrypt
+import primes
+import chatcore
+
+"""Benchmarks for the ciphers, prime math, handshakes and loopback chat
+
+Results are written as JSON and can be compared against a saved baseline:
+
+    python bench.py --output baseline.json
+    python bench.py --baseline baseline.json
+
+Exits with status 1 if any benchmark got slower than the baseline by more
+than the tolerance.
+"""
+
+MIN_TIME = 0.2 #seconds each measurement runs for
+REPEATS = 3 #measurements per benchmark, the fastest is kept
+
+#RFC 3526 2048-bit MODP group prime, a safe prime
+MODP_2048 = int("FFFFFFFFFFFFFFFFC90FDAA22168C234C4C6628B80DC1CD129024E088A67CC74"
+    "020BBEA63B139B22514A08798E3404DDEF9519B3CD3A431B302B0A6DF25F1437"
+    "4FE1356D6D51C245E485B576625E7EC6F44C42E9A637ED6B0BFF5CB6F406B7ED"
+    "EE386BFB5A899FA5AE9F24117C4B1FE649286651ECE45B3DC2007CB8A163BF05"
+    "98DA48361C55D39A69163FA8FD24CF5F83655D23DCA3AD961C62F356208552BB"
+    "9ED529077096966D670C354E4ABC9804F1746C08CA18217C32905E462E36CE3B"
+    "E39E772C180E86039B2783A2EC07A28FB5C55DF06F4C52C9DE2BCBF695581718"
+    "3995497CEA956AE515D2261898FA051015728E5A8AACAA68FFFFFFFFFFFFFFFF", 16)
+
+def measure(func, minTime=MIN_TIME, repeats=REPEATS):
+    """Returns the fastest time in seconds of one call to func"""
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for i in range(number):
+            func()
+        elapsed = time.perf_counter() - start
+        if elapsed >= minTime:
+            break
+        number *= 2 if elapsed == 0 else max(2, min(10, int(minTime/elapsed) + 1))
+    best = elapsed/number
+    for i in range(repeats - 1):
+        start = time.perf_counter()
+        for j in range(number):
+            func()
+        best = min(best, (time.perf_counter() - start)/number)
+    return best
+
+def sampleText(size):
+    """Returns size characters of mixed printable text"""
+    pattern = "The quick brown fox jumps over the lazy dog! 0123456789 "
+    return (pattern*(size//len(pattern) + 1))[:size]
+
+def benchCiphers(quick):
+    """Caesar and Vigenere throughput across message sizes and key lengths"""
+    results = {}
+    sizes = (1 << 10, 1 << 16) if quick else (1 << 10, 1 << 16, 1 << 20)
+    keyLengths = (1, 8, 64) if quick else (1, 8, 64, 1024)
+    for size in sizes:
+        text = sampleText(size)
+        caesar = Encrypt.Caesar((65,122), 7, False)
+        seconds = measure(lambda: caesar.encrypt(text))
+        results["caesar/encrypt/size=" + str(size)] = {"seconds": seconds, "rate": size/seconds/1e6, "rateUnit": "Mchar/s"}
+        for keyLength in keyLengths:
+            vigenere = Encrypt.Vigenere((65,122), Encrypt.genVigKey(keyLength), False)
+            seconds = measure(lambda: vigenere.encrypt(text))
+            results["vigenere/encrypt/size=" + str(size) + "/key=" + str(keyLength)] = {"seconds": seconds, "rate": size/seconds/1e6, "rateUnit": "Mchar/s"}
+    if not quick:
+        size = 64 << 20
+        data = bytes(sampleText(size), "ascii")
+        vigenere = Encrypt.Vigenere((65,122), Encrypt.genVigKey(64), False)
+        seconds = measure(lambda: vigenere.encryptParallel(data), repeats=1)
+        results["vigenere/encryptParallel/size=" + str(size) + "/key=64"] = {"seconds": seconds, "rate": size/seconds/1e6, "rateUnit": "Mchar/s"}
+    return results
+
+def benchPrimes(quick):
+    """isPrimitiveRoot and findPrime scaling with n"""
+    results = {}
+    moduli = [23, 7919, 1000003, 2**61 - 1]
+    if not quick:
+        moduli.append(MODP_2048)
+    for n in moduli:
+        g = primes.findPrimitiveRoot(n)
+        results["isPrimitiveRoot/bits=" + str(n.bit_length())] = {"seconds": measure(lambda: primes.isPrimitiveRoot(g, n))}
+    for k in ((1000, 10000) if quick else (1000, 10000, 100000, 1000000)):
+        #a fresh sieve every call, so nothing is served from an earlier run
+        results["findPrime/k=" + str(k)] = {"seconds": measure(lambda: primes.PrimeSieve().nthPrime(k))}
+    return results
+
+def benchHandshakes(quick):
+    """Locksmith and VigLocksmith handshake latency as the secret grows"""
+    results = {}
+    g = primes.findPrimitiveRoot(MODP_2048)
+    for bits in ((64, 256) if quick else (64, 256, 1024, 2048)):
+        secretA = 3 << (bits - 2)
+        secretB = (3 << (bits - 2)) + 12345
+        def handshake():
+            alice = Encrypt.Locksmith(g, MODP_2048, secretA)
+            bob = Encrypt.Locksmith(g, MODP_2048, secretB)
+            alice.makeKey(bob.makeIntermediateVal())
+            bob.makeKey(alice.makeIntermediateVal())
+        results["locksmith/handshake/secretBits=" + str(bits)] = {"seconds": measure(handshake)}
+    for length in ((5, 50) if quick else (5, 50, 500)):
+        secretA = Encrypt.genVigKey(length)
+        secretB = Encrypt.genVigKey(length)
+        def vigHandshake():
+            alice = Encrypt.VigLocksmith(5, 23, secretA)
+            bob = Encrypt.VigLocksmith(5, 23, secretB)
+            alice.makeKey(bob.makeIntermediateVal())
+            bob.makeKey(alice.makeIntermediateVal())
+        results["viglocksmith/handshake/secretLength=" + str(length)] = {"seconds": measure(vigHandshake)}
+    return results
+
+def benchLoopback(quick):
+    """End to end message rate between two chatcore Connections over loopback"""
+    count = 2000 if quick else 20000
+    listeningSocket = chatcore.listen(("127.0.0.1", 0))
+    address = listeningSocket.getsockname()
+    accepted = []
+    acceptThread = threading.Thread(target=lambda: accepted.append(chatcore.accept(listeningSocket, 5, 23)))
+    acceptThread.start()
+    sender = chatcore.connect(address, 5, 23)
+    acceptThread.join()
+    listeningSocket.close()
+    receiver = accepted[0]
+    message = sampleText(100)
+    def receiveAll():
+        for i in range(count):
+            receiver.receive()
+    receiveThread = threading.Thread(target=receiveAll)
+    start = time.perf_counter()
+    receiveThread.start()
+    for i in range(count):
+        sender.send(message)
+    receiveThread.join()
+    seconds = time.perf_counter() - start
+    sender.close()
+    receiver.close()
+    return {"loopback/messages=" + str(count): {"seconds": seconds/count, "rate": count/seconds, "rateUnit": "msg/s"}}
+
+BENCHMARKS = {"ciphers": benchCiphers, "primes": benchPrimes, "handshakes": benchHandshakes, "loopback": benchLoopback}
+
+def run(groups, quick=False):
+    """Runs the chosen benchmark groups and returns the results as a dict"""
+    results = {}
+    for name in groups:
+        print("running " + name, file=sys.stderr, flush=True)
+        results.update(BENCHMARKS[name](quick))
+    return {"meta": {"python": platform.python_version(), "platform": platform.platform(),
+                     "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "quick": quick},
+            "results": results}
+
+def compare(current, baseline, tolerance):
+    """Compares two run() outputs.
+
+    Returns:
+        List of (name, ratio) for benchmarks whose time per call grew by more
+        than tolerance (0.2 means 20% slower).
+    """
+    regressions = []
+    for name, result in current["results"].items():
+        old = baseline["results"].get(name)
+        if old is None or old["seconds"] <= 0:
+            continue
+        ratio = result["seconds"]/old["seconds"]
+        if ratio > 1 + tolerance:
+            regressions.append((name, ratio))
+    return regressions
+
+def main(argv=None):
+    """Runs the benchmarks from the command line"""
+    parser = argparse.ArgumentParser(description="Benchmarks for ciphers, prime math, handshakes and loopback chat")
+    parser.add_argument("groups", nargs="*", help="groups to run, any of " + ", ".join(BENCHMARKS) + ". All by default")
+    parser.add_argument("--output", help="file to write the JSON results to, stdout by default")
+    parser.add_argument("--baseline", help="JSON results to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown against the baseline, 0.2 is 20%%")
+    parser.add_argument("--quick", action="store_true", help="smaller sizes for a fast smoke run")
+    args = parser.parse_args(argv)
+    for group in args.groups:
+        if group not in BENCHMARKS:
+            parser.error("unknown benchmark group " + group)
+
+    current = run(args.groups or list(BENCHMARKS), args.quick)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(current, f, indent=2, sort_keys=True)
+    else:
+        json.dump(current, sys.stdout, indent=2, sort_keys=True)
+        print()
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(current, baseline, args.tolerance)
+        for name, ratio in regressions:
+            print("REGRESSION " + name + ": " + format(ratio, ".2f") + "x slower", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+import argparse
+import sys
+import threading
+import chatcore
+import handshake
+import keypool
+import metrics
+import tickets
+
+"""Command line entry point for the chat
+
+Runs without a display: "listen" waits for peers (optionally echoing their
+messages back, as a simple bot), "connect" chats over stdin/stdout and
+"relay" runs the asyncio ChatServer. "gui" opens the Tk client, and only
+then is tkinter imported.
+"""
+
+def _printMessages(connection, label):
+    """Prints every message received on connection until it closes"""
+    try:
+        while True:
+            message = connection.receive()
+            if message is None:
+                break
+            print(label + ": " + message, flush=True)
+    except (OSError, ValueError) as e:
+        print(label + ": " + str(e), file=sys.stderr, flush=True)
+    print(label + " disconnected", flush=True)
+
+def _serveEcho(connection, label):
+    """Sends every message received on connection straight back"""
+    try:
+        while True:
+            message = connection.receive()
+            if message is None:
+                break
+            print(label + ": " + message, flush=True)
+            connection.send(message)
+    except (OSError, ValueError) as e:
+        print(label + ": " + str(e), file=sys.stderr, flush=True)
+    finally:
+        connection.close()
+
+def _singleUseSecret(g, n, secret):
+    """Returns a makeLocksmith for Handshaker.listen that uses secret for one peer only
+
+    Every peer given the same secret would get the same intermediate value,
+    so later peers are refused.
+    """
+    lock = threading.Lock()
+    used = []
+    def makeLocksmith():
+        with lock:
+            if used:
+                raise ValueError("--secret has already been used for a peer, leave it out for random secrets")
+            used.append(True)
+        return chatcore.newLocksmith(g, n, secret)
+    return makeLocksmith
+
+def runListen(args):
+    """Accepts peers until interrupted, each one on its own thread
+
+    Handshakes run on a handshake.Handshaker, so a peer that hangs up or
+    never answers only fails its own handshake, after READ_TIMEOUT at most,
+    while others keep being accepted.
+    """
+    if args.secret is None:
+        keyPool = keypool.KeyPool(args.g, args.n)
+        makeLocksmith = keyPool.take
+    else:
+        keyPool = None
+        makeLocksmith = _singleUseSecret(args.g, args.n, args.secret)
+    handler = _serveEcho if args.echo else _printMessages
+    def onEvent(event, detail):
+        if event == "done":
+            try:
+                label = ":".join(map(str, detail.soc.getpeername()))
+            except OSError:
+                detail.close() #gone already
+                return
+            thread = threading.Thread(target=handler, args=(detail, label))
+            thread.daemon = True
+            thread.start()
+        elif event == "failed":
+            print("handshake failed: " + str(detail), file=sys.stderr, flush=True)
+    handshaker = handshake.Handshaker()
+    try:
+        handshaker.listen(chatcore.parseAddress(args.address), makeLocksmith, onEvent, tickets.TicketCache())
+        print("listening on " + args.address, flush=True)
+        threading.Event().wait() #until interrupted
+    finally:
+        handshaker.close()
+        if keyPool is not None:
+            keyPool.close()
+
+def runConnect(args):
+    """Sends lines from stdin and prints what comes back"""
+    connection = chatcore.connect(chatcore.parseAddress(args.address), args.g, args.n, args.secret)
+    thread = threading.Thread(target=_printMessages, args=(connection, "Them"))
+    thread.daemon = True
+    thread.start()
+    try:
+        for line in sys.stdin:
+            connection.send(line.rstrip("\n"))
+    finally:
+        connection.close()
+
+def runRelay(args):
+    """Runs the asyncio ChatServer"""
+    import asyncio
+    import asyncchat
+    asyncio.run(asyncchat.ChatServer(args.g, args.n).serveForever(*chatcore.parseAddress(args.address)))
+
+def runGui(args):
+    """Opens the Tk client"""
+    import startUI
+    startUI.main(args.history_dir)
+
+def main(argv=None):
+    """Parses the command line and runs the chosen command"""
+    defaultAddress = chatcore.DEFAULT_ADDRESS[0] + ":" + str(chatcore.DEFAULT_ADDRESS[1])
+    parser = argparse.ArgumentParser(description="Diffie-Hellman/Vigenere chat")
+    parser.add_argument("-g", type=int, default=5, help="primitive root of n")
+    parser.add_argument("-n", type=int, default=23, help="prime modulus")
+    parser.add_argument("--secret", help="VigLocksmith secret, random if not given")
+    parser.add_argument("--metrics", metavar="FILE", help="record metrics and append them to FILE as JSON lines, - for stdout")
+    parser.add_argument("--metrics-interval", type=float, default=10.0, help="seconds between metrics snapshots")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    listenParser = commands.add_parser("listen", help="wait for peers to connect")
+    listenParser.add_argument("address", nargs="?", default=defaultAddress, help="host:port to listen on")
+    listenParser.add_argument("--echo", action="store_true", help="send every message back to its sender")
+    listenParser.set_defaults(run=runListen)
+
+    connectParser = commands.add_parser("connect", help="chat with a peer over stdin/stdout")
+    connectParser.add_argument("address", help="host:port to connect to")
+    connectParser.set_defaults(run=runConnect)
+
+    relayParser = commands.add_parser("relay", help="run the asyncio chat room server")
+    relayParser.add_argument("address", nargs="?", default=defaultAddress, help="host:port to listen on")
+    relayParser.set_defaults(run=runRelay)
+
+    guiParser = commands.add_parser("gui", help="open the Tk chat client")
+    guiParser.add_argument("--history-dir", help="keep chat logs in this directory, otherwise they are removed when each chat closes")
+    guiParser.set_defaults(run=runGui)
+
+    args = parser.parse_args(argv)
+    exporter = None
+    if args.metrics is not None:
+        metrics.enable()
+        if args.metrics == "-":
+            exporter = metrics.Exporter(sys.stdout, args.metrics_interval)
+        else:
+            exporter = metrics.FileExporter(args.metrics, args.metrics_interval)
+        exporter.start()
+    try:
+        args.run(args)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if exporter is not None:
+            exporter.stop()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,334 @@
+import itertools
+import socket
+import Encrypt
+import framing
+import metrics
+import tickets
+
+"""Networking and key exchange for the chat, without any UI
+
+Used by the Tk client in startUI and by the headless chatcli. The connecting
+party sends its VigLocksmith intermediate value first and the listening
+party answers with its own, both in handshake frames. After that every chat
+frame carries a Vigenere encrypted message.
+
+A connecting party holding a ticket from an earlier handshake (see tickets)
+first sends a resume frame with the ticket id and a nonce. If the listening
+party still has the ticket it answers with its own nonce and both derive
+the session key from them. Otherwise it answers with an empty resume frame
+and the full handshake follows on the same connection.
+"""
+
+DEFAULT_ADDRESS = ("127.0.0.1", 25123)
+CHAR_RANGE = (65,122)
+
+_connectionIds = itertools.count(1)
+
+def parseAddress(text):
+    """Turns "host:port" into a (host, int port) tuple"""
+    host, port = text.rsplit(":", 1)
+    return host, int(port)
+
+def newLocksmith(g, n, secret, keyPool=None):
+    """Returns a (locksmith, intermediate value) tuple for a handshake.
+
+    Args:
+        g(int): A primitive root of n
+        n(int): A prime number
+        secret(str): VigLocksmith secret. If None, one is taken from keyPool.
+        keyPool(KeyPool, optional): Pool to take from when secret is None.
+
+    """
+    with metrics.timer("handshake.locksmith"):
+        if secret is None and keyPool is not None:
+            return keyPool.take()
+        if secret is None:
+            secret = Encrypt.genVigKey(5)
+        locksmith = Encrypt.VigLocksmith(g, n, secret)
+        return locksmith, locksmith.makeIntermediateVal()
+
+def readHandshake(frameReader):
+    """Reads the other party's intermediate value from a handshake frame
+
+    Raises:
+        ValueError: If the next frame is not a handshake frame, or is empty.
+        ConnectionError: If the connection closes first.
+    """
+    return _handshakeValue(frameReader.readFrame())
+
+def _handshakeValue(frame):
+    """Returns the intermediate value carried by frame, see readHandshake"""
+    if frame is None:
+        raise ConnectionError("Connection closed during handshake")
+    frameType, payload = frame
+    if frameType != framing.FRAME_HANDSHAKE:
+        raise ValueError("Expected a handshake frame, got type " + str(frameType))
+    if len(payload) == 0:
+        raise ValueError("Empty handshake value, it would give an empty key")
+    return str(payload, "utf-8")
+
+def connectHandshake(soc, locksmith, intermediateVal):
+    """Agrees on a key as the connecting party.
+
+    Args:
+        soc(socket): Connected socket
+        locksmith(VigLocksmith): Locksmith whose intermediate value is
+            intermediateVal
+        intermediateVal(str): Value sent to the other party
+
+    Returns:
+        A Connection using the agreed key.
+    """
+    with metrics.timer("handshake.send"):
+        framing.sendFrame(soc, framing.FRAME_HANDSHAKE, bytes(intermediateVal, "utf-8"))
+    frameReader = framing.FrameReader(soc)
+    with metrics.timer("handshake.receive"):
+        otherKey = readHandshake(frameReader)
+    with metrics.timer("handshake.makeKey"):
+        key = locksmith.makeKey(otherKey)
+    return Connection(soc, Encrypt.Vigenere(CHAR_RANGE, key, False), frameReader, tickets.makeTicket(key))
+
+def resumeHandshake(soc, ticket):
+    """Tries to resume an earlier session as the connecting party.
+
+    Args:
+        soc(socket): Connected socket
+        ticket(Ticket): Ticket from an earlier Connection to the same party
+
+    Returns:
+        A Connection using a key derived from the ticket, or None if the
+        other party no longer accepts it. soc can then be used for
+        connectHandshake.
+    """
+    clientNonce = tickets.newNonce()
+    with metrics.timer("handshake.resume"):
+        framing.sendFrame(soc, framing.FRAME_RESUME, ticket.ticketId + clientNonce)
+        frameReader = framing.FrameReader(soc)
+        frame = frameReader.readFrame()
+    if frame is None:
+        raise ConnectionError("Connection closed during handshake")
+    frameType, serverNonce = frame
+    if frameType != framing.FRAME_RESUME:
+        raise ValueError("Expected a resume frame, got type " + str(frameType))
+    if len(serverNonce) != tickets.NONCE_SIZE:
+        if metrics.enabled:
+            metrics.increment("handshake.resumeRejected")
+        return None
+    if metrics.enabled:
+        metrics.increment("handshake.resumed")
+    key = tickets.sessionKey(ticket, clientNonce, bytes(serverNonce), CHAR_RANGE)
+    return Connection(soc, Encrypt.Vigenere(CHAR_RANGE, key, False), frameReader, ticket, True)
+
+def _acceptResume(soc, frameReader, payload, ticketCache):
+    """Answers a resume frame. Returns a Connection, or None if the ticket is unknown"""
+    ticket = None
+    if ticketCache is not None and len(payload) == tickets.TICKET_ID_SIZE + tickets.NONCE_SIZE:
+        ticket = ticketCache.get(payload[:tickets.TICKET_ID_SIZE])
+    if ticket is None:
+        framing.sendFrame(soc, framing.FRAME_RESUME, b"")
+        if metrics.enabled:
+            metrics.increment("handshake.resumeRejected")
+        return None
+    serverNonce = tickets.newNonce()
+    framing.sendFrame(soc, framing.FRAME_RESUME, serverNonce)
+    if metrics.enabled:
+        metrics.increment("handshake.resumed")
+    key = tickets.sessionKey(ticket, payload[tickets.TICKET_ID_SIZE:], serverNonce, CHAR_RANGE)
+    return Connection(soc, Encrypt.Vigenere(CHAR_RANGE, key, False), frameReader, ticket, True)
+
+def acceptHandshake(soc, locksmith, intermediateVal, ticketCache=None):
+    """Agrees on a key as the listening party.
+
+    Args:
+        soc(socket): Socket returned by accept
+        locksmith(VigLocksmith): Locksmith whose intermediate value is
+            intermediateVal. Unused if the session is resumed.
+        intermediateVal(str): Value sent to the other party
+        ticketCache(TicketCache, optional): Tickets the other party may
+            resume, by ticket id. The ticket of a full handshake is added to
+            it. Without it every resume is refused.
+
+    Returns:
+        A Connection using the agreed key.
+    """
+    frameReader = framing.FrameReader(soc)
+    with metrics.timer("handshake.receive"):
+        frame = frameReader.readFrame()
+        if frame is not None and frame[0] == framing.FRAME_RESUME:
+            connection = _acceptResume(soc, frameReader, bytes(frame[1]), ticketCache)
+            if connection is not None:
+                return connection
+            frame = frameReader.readFrame()
+        otherKey = _handshakeValue(frame)
+    with metrics.timer("handshake.makeKey"):
+        key = locksmith.makeKey(otherKey)
+    with metrics.timer("handshake.send"):
+        framing.sendFrame(soc, framing.FRAME_HANDSHAKE, bytes(intermediateVal, "utf-8"))
+    ticket = tickets.makeTicket(key)
+    if ticketCache is not None:
+        ticketCache.add(ticket.ticketId, ticket)
+    return Connection(soc, Encrypt.Vigenere(CHAR_RANGE, key, False), frameReader, ticket)
+
+class Connection:
+    """Blocking encrypted chat connection to one other party.
+
+    Attributes:
+        soc(socket): Socket to the other party
+        encrypter(encryption class): must have encryptInto and decryptInto
+            methods (see Encrypt.Vigenere or Encrypt.Caesar), which work on
+            the UTF-8 bytes of messages. None sends plaintext.
+        frameReader(FrameReader): Reads frames from soc
+        messagesSent(int): Chat messages sent on this connection
+        messagesReceived(int): Chat messages received on this connection
+        bytesSent(int): Chat payload bytes sent on this connection
+        bytesReceived(int): Chat payload bytes received on this connection
+        ticket(Ticket): Ticket for resuming this session later, or None
+        resumed(bool): True if the session was resumed from a ticket
+        sessionName(str): Peer address and a connection number, naming
+            this connection's counters in metrics snapshots
+
+    """
+    def __init__(self, soc, encrypter=None, frameReader=None, ticket=None, resumed=False):
+        """Creates a Connection.
+
+        Args:
+            soc(socket): Socket to the other party
+            encrypter(encryption class, optional): Cipher for messages
+            frameReader(FrameReader, optional): reader already used on soc
+                during the handshake, so no buffered data is lost
+            ticket(Ticket, optional): Ticket for resuming this session
+            resumed(bool, optional): Whether the session came from a ticket
+
+        """
+        self.soc = soc
+        self.encrypter = encrypter
+        self.frameReader = frameReader if frameReader is not None else framing.FrameReader(soc)
+        self.messagesSent = 0
+        self.messagesReceived = 0
+        self.bytesSent = 0
+        self.bytesReceived = 0
+        self.ticket = ticket
+        self.resumed = resumed
+        try:
+            peer = ":".join(map(str, soc.getpeername()[:2]))
+        except OSError:
+            peer = "unknown"
+        self.sessionName = peer + "#" + str(next(_connectionIds))
+
+    def send(self, message):
+        """Encrypts message straight into the frame and sends it"""
+        frame = framing.frameBuffer(framing.FRAME_CHAT, bytes(message, "utf-8"))
+        size = len(frame) - framing.HEADER.size
+        if self.encrypter is not None:
+            with memoryview(frame) as view:
+                self.encrypter.encryptInto(view[framing.HEADER.size:])
+        framing.sendPacked(self.soc, frame)
+        self.messagesSent += 1
+        self.bytesSent += size
+        if metrics.enabled:
+            metrics.increment("session.messagesSent")
+            metrics.increment("session.bytesSent", size)
+            metrics.incrementSession(self.sessionName, "messagesSent")
+            metrics.incrementSession(self.sessionName, "bytesSent", size)
+
+    def receive(self):
+        """Waits for the next message.
+
+        Returns:
+            The decrypted message, or None once the other party has closed
+            the connection.
+        """
+        while True:
+            frame = self.frameReader.readFrame()
+            if frame is None:
+                return None
+            frameType, payload = frame
+            if frameType == framing.FRAME_CHAT:
+                break
+        self.messagesReceived += 1
+        self.bytesReceived += len(payload)
+        if metrics.enabled:
+            metrics.increment("session.messagesReceived")
+            metrics.increment("session.bytesReceived", len(payload))
+            metrics.incrementSession(self.sessionName, "messagesReceived")
+            metrics.incrementSession(self.sessionName, "bytesReceived", len(payload))
+        if self.encrypter is not None:
+            #the payload is a view of the receive buffer, decrypt it right there
+            self.encrypter.decryptInto(payload)
+        return str(payload, "utf-8")
+
+    def close(self):
+        """Closes the socket and drops this connection's metrics"""
+        self.soc.close()
+        if metrics.enabled:
+            metrics.endSession(self.sessionName)
+
+def connect(address, g, n, secret=None, keyPool=None, ticketCache=None):
+    """Connects to a listening party and agrees on a key.
+
+    Args:
+        address(tuple): String address, int port
+        g(int): A primitive root of n
+        n(int): A prime number
+        secret(str, optional): VigLocksmith secret, see newLocksmith
+        keyPool(KeyPool, optional): see newLocksmith
+        ticketCache(TicketCache, optional): Tickets by address. A ticket for
+            address is resumed if the other party accepts it. Otherwise it
+            is discarded and a full handshake, on a new socket if the other
+            party hung up, stores its ticket here.
+
+    Returns:
+        A Connection using the agreed key.
+    """
+    soc = socket.create_connection(address)
+    try:
+        ticket = ticketCache.get(address) if ticketCache is not None else None
+        if ticket is not None:
+            try:
+                connection = resumeHandshake(soc, ticket)
+            except (OSError, ValueError):
+                #e.g. a peer that does not know resumption and hung up
+                connection = None
+                soc.close()
+                soc = socket.create_connection(address)
+            if connection is not None:
+                return connection
+            ticketCache.discard(address)
+        locksmith, intermediateVal = newLocksmith(g, n, secret, keyPool)
+        connection = connectHandshake(soc, locksmith, intermediateVal)
+        if ticketCache is not None:
+            ticketCache.add(address, connection.ticket)
+        return connection
+    except:
+        soc.close()
+        raise
+
+def listen(address, backlog=5):
+    """Returns a socket bound to address and listening"""
+    listeningSocket = socket.socket()
+    listeningSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listeningSocket.bind(address)
+    listeningSocket.listen(backlog)
+    return listeningSocket
+
+def accept(listeningSocket, g, n, secret=None, keyPool=None, ticketCache=None):
+    """Waits for one party to connect and agrees on a key with it.
+
+    Args:
+        listeningSocket(socket): Socket from listen
+        g(int): A primitive root of n
+        n(int): A prime number
+        secret(str, optional): VigLocksmith secret, see newLocksmith
+        keyPool(KeyPool, optional): see newLocksmith
+        ticketCache(TicketCache, optional): see acceptHandshake
+
+    Returns:
+        A Connection using the agreed key.
+    """
+    soc, address = listeningSocket.accept()
+    try:
+        locksmith, intermediateVal = newLocksmith(g, n, secret, keyPool)
+        return acceptHandshake(soc, locksmith, intermediateVal, ticketCache)
+    except:
+        soc.close()
+        raise
@@ -0,0 +1,167 @@
+import os
+import functools
+import threading
+import weakref
+
+"""Buffered randomness for keys, secrets and exponents
+
+Reading os.urandom a byte or two at a time costs a system call each time,
+which limits how fast long keys and many secrets can be made. An
+EntropyPool reads os.urandom in large blocks and hands the bytes out from
+its buffer. Integers and key characters are made by rejection sampling, so
+they are uniform over their range.
+
+Buffered bytes are thrown away in a forked child (with os.register_at_fork
+where available, and by checking the process id otherwise), so the parent
+and the processes of a pool never hand out the same bytes.
+"""
+
+BLOCK_SIZE = 4096 #bytes read from os.urandom at a time
+
+_pools = weakref.WeakSet()
+
+def _discardAll():
+    """Empties every pool and replaces its lock. Runs in the child after a fork"""
+    for pool in list(_pools):
+        pool._afterFork()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_discardAll)
+
+@functools.lru_cache(maxsize=64)
+def samplingTable(charRange):
+    """Returns (table, rejected) for turning random bytes into characters of charRange
+
+    bytes.translate(table, rejected) maps each byte to a character code and
+    deletes the bytes that would make some characters more likely than
+    others, so what is left is uniform over charRange.
+
+    Args:
+        charRange(tuple of 2 ints): Inclusive range within 0-255, at most
+            256 characters
+
+    """
+    low, high = charRange
+    size = high - low + 1
+    limit = 256 - 256 % size #bytes at or above this would bias the result
+    return bytes(low + b % size if b < limit else 0 for b in range(256)), bytes(range(limit, 256))
+
+class EntropyPool:
+    """Buffer of os.urandom bytes shared by everything that needs randomness.
+
+    Attributes:
+        blockSize(int): Bytes read from os.urandom at a time
+
+    """
+    def __init__(self, blockSize=BLOCK_SIZE):
+        """Creates an empty pool. It is filled on first use.
+
+        Args:
+            blockSize(int, optional): Bytes read from os.urandom at a time
+
+        """
+        self.blockSize = blockSize
+        self._lock = threading.Lock()
+        self._buffer = b""
+        self._position = 0
+        self._pid = os.getpid()
+        _pools.add(self)
+
+    def _discard(self):
+        """Throws away the buffered bytes"""
+        self._buffer = b""
+        self._position = 0
+        self._pid = os.getpid()
+
+    def _afterFork(self):
+        """Resets the pool in a forked child
+
+        The lock may have been held by a thread of the parent, which does
+        not exist in the child, so a new one replaces it.
+        """
+        self._lock = threading.Lock()
+        self._discard()
+
+    def randomBytes(self, n):
+        """Returns n random bytes"""
+        if n >= self.blockSize:
+            return os.urandom(n)
+        with self._lock:
+            if self._pid != os.getpid():
+                self._discard()
+            end = self._position + n
+            if end > len(self._buffer):
+                #the rest of the old block is dropped rather than stitched on
+                self._buffer = os.urandom(self.blockSize)
+                self._position = 0
+                end = n
+            data = self._buffer[self._position:end]
+            self._position = end
+            return data
+
+    def randbits(self, k):
+        """Returns a random integer with k random bits"""
+        if k <= 0:
+            return 0
+        numBytes = (k + 7)//8
+        return int.from_bytes(self.randomBytes(numBytes), "big") >> (8*numBytes - k)
+
+    def randbelow(self, n):
+        """Returns a uniformly random integer in [0, n)
+
+        Raises:
+            ValueError: If n is not positive.
+        """
+        if n <= 0:
+            raise ValueError("randbelow needs a positive bound, not " + str(n))
+        k = n.bit_length()
+        while True:
+            candidate = self.randbits(k)
+            if candidate < n:
+                return candidate
+
+    def randomString(self, length, charRange):
+        """Returns length characters drawn uniformly from charRange
+
+        For ranges of at most 256 characters, whole blocks of bytes are
+        mapped with bytes.translate, and bytes that would bias the result
+        are deleted in the same call.
+
+        Args:
+            length(int): Number of characters
+            charRange(tuple of 2 ints): Inclusive range of character codes
+
+        """
+        low, high = charRange
+        size = high - low + 1
+        if high > 255:
+            return "".join(chr(low + self.randbelow(size)) for i in range(length))
+        table, rejected = samplingTable((low, high))
+        chars = b""
+        while len(chars) < length:
+            needed = length - len(chars)
+            #enough extra that one round is nearly always enough
+            chars += self.randomBytes(needed + needed*len(rejected)//(256 - len(rejected)) + 16).translate(table, rejected)
+        return chars[:length].decode("latin-1")
+
+_pool = EntropyPool()
+
+def defaultPool():
+    """Returns the pool shared by the whole process"""
+    return _pool
+
+def randomBytes(n):
+    """Returns n random bytes from the default pool"""
+    return _pool.randomBytes(n)
+
+def randbits(k):
+    """Returns a random integer with k random bits from the default pool"""
+    return _pool.randbits(k)
+
+def randbelow(n):
+    """Returns a uniformly random integer in [0, n) from the default pool"""
+    return _pool.randbelow(n)
+
+def randomString(length, charRange):
+    """Returns length characters drawn uniformly from charRange, see EntropyPool.randomString"""
+    return _pool.randomString(length, charRange)
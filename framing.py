@@ -0,0 +1,176 @@
+import struct
+import asyncio
+import time
+import metrics
+
+"""Length-prefixed frames for the chat wire protocol
+
+Every frame is a 4 byte big-endian payload length, a 1 byte frame type and
+then the payload. Frames are read into one preallocated buffer per
+connection, so receiving a message allocates nothing and copies nothing.
+"""
+
+HEADER = struct.Struct(">IB")
+FRAME_HANDSHAKE = 1 #payload is a locksmith intermediate value
+FRAME_CHAT = 2 #payload is an encrypted chat message
+FRAME_RESUME = 3 #payload is a ticket id and nonce, or the answer to one
+MAX_FRAME_SIZE = 16 << 20
+DEFAULT_BUFFER_SIZE = 64 << 10
+
+def packFrame(frameType, payload):
+    """Returns the bytes of a frame carrying payload"""
+    if len(payload) > MAX_FRAME_SIZE:
+        raise ValueError("Frame of " + str(len(payload)) + " bytes is larger than " + str(MAX_FRAME_SIZE))
+    return HEADER.pack(len(payload), frameType) + payload
+
+def frameBuffer(frameType, payload):
+    """Returns a frame carrying payload as a bytearray
+
+    The payload is at HEADER.size onwards and can be changed in place, e.g.
+    encrypted with encryptInto, before the frame is sent with sendPacked.
+    """
+    if len(payload) > MAX_FRAME_SIZE:
+        raise ValueError("Frame of " + str(len(payload)) + " bytes is larger than " + str(MAX_FRAME_SIZE))
+    frame = bytearray(HEADER.size + len(payload))
+    HEADER.pack_into(frame, 0, len(payload), frameType)
+    frame[HEADER.size:] = payload
+    return frame
+
+def sendFrame(soc, frameType, payload):
+    """Sends one frame over a blocking socket
+
+    Args:
+        soc(socket): Socket to send on
+        frameType(int): FRAME_HANDSHAKE or FRAME_CHAT
+        payload(bytes-like): Frame contents
+    """
+    sendPacked(soc, packFrame(frameType, payload))
+
+def sendPacked(soc, data):
+    """Sends a frame from packFrame or frameBuffer over a blocking socket"""
+    if not metrics.enabled:
+        soc.sendall(data)
+        return
+    start = time.perf_counter()
+    soc.sendall(data)
+    metrics.observe("socket.send", time.perf_counter() - start)
+    metrics.increment("socket.bytesSent", len(data))
+    metrics.increment("socket.framesSent")
+
+class FrameReader:
+    """Reads frames from a blocking socket into one reusable buffer.
+
+    Data is received with recv_into straight into the buffer, and payloads
+    are handed out as memoryviews of it. The buffer only grows when a single
+    frame does not fit.
+
+    Attributes:
+        soc(socket): Socket frames are read from.
+        maxFrameSize(int): Largest payload accepted.
+
+    """
+    def __init__(self, soc, bufferSize=DEFAULT_BUFFER_SIZE, maxFrameSize=MAX_FRAME_SIZE):
+        """Creates a FrameReader.
+
+        Args:
+            soc(socket): Socket frames are read from.
+            bufferSize(int, optional): Initial size of the receive buffer.
+            maxFrameSize(int, optional): Largest payload accepted.
+
+        """
+        self.soc = soc
+        self.maxFrameSize = maxFrameSize
+        self._buffer = bytearray(bufferSize)
+        self._view = memoryview(self._buffer)
+        self._start = 0 #first byte not yet handed out
+        self._end = 0 #end of received data
+
+    def _fill(self, needed):
+        """Receives until needed bytes are buffered. Returns False at end of stream"""
+        while self._end - self._start < needed:
+            if self._start + needed > len(self._buffer):
+                #move the partial frame to the front, growing the buffer if it
+                #still does not fit
+                pending = self._view[self._start:self._end]
+                if needed > len(self._buffer):
+                    newBuffer = bytearray(max(needed, 2*len(self._buffer)))
+                    newBuffer[:len(pending)] = pending
+                    pending.release()
+                    self._buffer = newBuffer
+                    self._view = memoryview(newBuffer)
+                else:
+                    self._buffer[:len(pending)] = bytes(pending)
+                    pending.release()
+                self._end -= self._start
+                self._start = 0
+            if metrics.enabled:
+                start = time.perf_counter()
+                received = self.soc.recv_into(self._view[self._end:])
+                metrics.observe("socket.recv", time.perf_counter() - start)
+                metrics.increment("socket.bytesReceived", received)
+            else:
+                received = self.soc.recv_into(self._view[self._end:])
+            if received == 0:
+                return False
+            self._end += received
+        return True
+
+    def readFrame(self):
+        """Waits for the next frame.
+
+        The payload is a view of the receive buffer and is only valid until
+        the next call to readFrame. Copy it (e.g. with bytes()) to keep it.
+
+        Returns:
+            Tuple (frameType, payload memoryview), or None if the connection
+            was closed between frames.
+
+        Raises:
+            ValueError: If the frame is larger than maxFrameSize.
+            ConnectionError: If the connection was closed part way through a
+                frame.
+        """
+        if self._start == self._end:
+            self._start = self._end = 0
+        if not self._fill(HEADER.size):
+            if self._end != self._start:
+                raise ConnectionError("Connection closed part way through a frame")
+            return None
+        length, frameType = HEADER.unpack_from(self._buffer, self._start)
+        if length > self.maxFrameSize:
+            raise ValueError("Frame of " + str(length) + " bytes is larger than " + str(self.maxFrameSize))
+        if not self._fill(HEADER.size + length):
+            raise ConnectionError("Connection closed part way through a frame")
+        payloadStart = self._start + HEADER.size
+        self._start = payloadStart + length
+        return frameType, self._view[payloadStart:self._start]
+
+def writeFrame(writer, frameType, payload):
+    """Queues one frame on an asyncio StreamWriter"""
+    writer.write(packFrame(frameType, payload))
+
+async def readFrameAsync(reader, maxFrameSize=MAX_FRAME_SIZE):
+    """Reads one frame from an asyncio StreamReader.
+
+    Returns:
+        Tuple (frameType, payload bytes), or None if the connection was
+        closed between frames.
+
+    Raises:
+        ValueError: If the frame is larger than maxFrameSize.
+        ConnectionError: If the connection was closed part way through a
+            frame.
+    """
+    try:
+        header = await reader.readexactly(HEADER.size)
+    except asyncio.IncompleteReadError as e:
+        if e.partial:
+            raise ConnectionError("Connection closed part way through a frame")
+        return None
+    length, frameType = HEADER.unpack(header)
+    if length > maxFrameSize:
+        raise ValueError("Frame of " + str(length) + " bytes is larger than " + str(maxFrameSize))
+    try:
+        return frameType, await reader.readexactly(length)
+    except asyncio.IncompleteReadError:
+        raise ConnectionError("Connection closed part way through a frame")
@@ -0,0 +1,180 @@
+import collections
+import json
+import os
+import tempfile
+import threading
+import primes
+
+"""Registry of validated Diffie-Hellman groups
+
+Checking that g is a primitive root of n means factoring n-1, which is slow
+for big n, yet most deployments use the same few (g, n) groups for every
+connection. The registry checks each group once and remembers the answer,
+along with the factorization of n-1, in an LRU.
+
+If CHAT_GROUP_CACHE names a file, the factorizations are also written there
+and loaded again when the next process starts. Loaded entries are not taken
+on trust: each one is checked again with its stored factors, which costs a
+few modular exponentiations instead of a factorization. Without
+CHAT_GROUP_CACHE the registry is kept in memory only.
+"""
+
+GROUP_CACHE_SIZE = 64 #number of groups kept in memory and on disk
+CACHE_VERSION = 1
+DEFAULT_CACHE_PATH = os.environ.get("CHAT_GROUP_CACHE") or None
+
+class GroupRegistry:
+    """LRU of (g, n) validation results, optionally saved to a file.
+
+    Attributes:
+        path(str): Cache file, None to keep the results in memory only
+        maxSize(int): Number of groups kept before the least recently used
+            one is evicted
+
+    """
+    def __init__(self, path=None, maxSize=GROUP_CACHE_SIZE):
+        """Creates the registry and loads path if it exists.
+
+        Args:
+            path(str, optional): Cache file, None to keep the results in
+                memory only
+            maxSize(int, optional): Number of groups kept
+
+        """
+        self.path = path
+        self.maxSize = maxSize
+        self._groups = collections.OrderedDict() #(g, n) -> (valid, factors of n-1)
+        self._lock = threading.Lock()
+        if path is not None:
+            self.load()
+
+    def _remember(self, g, n, valid, factors):
+        """Adds a result, evicting the least recently used if full"""
+        self._groups[(g, n)] = (valid, factors)
+        self._groups.move_to_end((g, n))
+        while len(self._groups) > self.maxSize:
+            self._groups.popitem(last=False)
+
+    def lookup(self, g, n):
+        """Returns the cached (valid, factors) for g and n, or None"""
+        with self._lock:
+            entry = self._groups.get((g, n))
+            if entry is not None:
+                self._groups.move_to_end((g, n))
+            return entry
+
+    def validate(self, g, n):
+        """Checks that g is a primitive root of the prime n, once per group
+
+        Returns:
+            True if g is a primitive root of n, False otherwise.
+        """
+        entry = self.lookup(g, n)
+        if entry is not None:
+            return entry[0]
+        if n > 2 and (pow(g, n-1, n) != 1 or not primes.isProbablePrime(n)):
+            #composite n, rejected before factoring n-1, which might never finish
+            valid, factors = False, None
+        else:
+            factors = self.factors(n)
+            if factors is None and n > 2:
+                factors = primes.factorize(n-1)
+            valid = primes.isPrimitiveRoot(g, n, factors)
+        with self._lock:
+            self._remember(g, n, valid, factors)
+        if self.path is not None:
+            self.save()
+        return valid
+
+    def factors(self, n):
+        """Returns the cached prime factorization of n-1 as a dict, or None"""
+        with self._lock:
+            for (g, otherN), (valid, factors) in self._groups.items():
+                if otherN == n and factors is not None:
+                    return dict(factors)
+        return None
+
+    def load(self):
+        """Replaces the registry's contents with those of the cache file
+
+        A missing, unreadable or outdated file leaves the registry empty.
+        Entries whose stored factors do not check out are skipped, see
+        _verify.
+        """
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            if data.get("version") != CACHE_VERSION:
+                return
+            groups = [(entry["g"], entry["n"], None if entry["factors"] is None else {p: e for p, e in entry["factors"]})
+                      for entry in data["groups"]]
+            groups = [(g, n, factors) for g, n, factors in groups if _verify(g, n, factors)]
+        except (OSError, ValueError, KeyError, TypeError):
+            return
+        with self._lock:
+            self._groups.clear()
+            for g, n, factors in groups:
+                self._remember(g, n, primes.isPrimitiveRoot(g, n, factors), factors)
+
+    def save(self):
+        """Writes the registry to the cache file
+
+        The file is replaced atomically, so a concurrent reader sees either
+        the old or the new contents. Failing to write is not an error, the
+        registry just starts empty next time.
+        """
+        with self._lock:
+            groups = [{"g": g, "n": n, "valid": valid,
+                       "factors": None if factors is None else sorted(factors.items())}
+                      for (g, n), (valid, factors) in self._groups.items()]
+        directory = os.path.dirname(os.path.abspath(self.path))
+        try:
+            os.makedirs(directory, exist_ok=True)
+            fd, tempPath = tempfile.mkstemp(dir=directory, prefix=".groups-")
+            try:
+                with os.fdopen(fd, "w") as f:
+                    json.dump({"version": CACHE_VERSION, "groups": groups}, f)
+                os.replace(tempPath, self.path)
+            except:
+                os.unlink(tempPath)
+                raise
+        except OSError:
+            pass
+
+    def clear(self):
+        """Forgets every group, in memory and in the cache file"""
+        with self._lock:
+            self._groups.clear()
+        if self.path is not None:
+            self.save()
+
+def _verify(g, n, factors):
+    """Whether a loaded entry can be used: factors must be the prime factorization of n-1
+
+    With a correct factorization, isPrimitiveRoot(g, n, factors) decides
+    validity exactly, so the file's own answer is never needed.
+    """
+    if not (isinstance(g, int) and isinstance(n, int) and n > 2) or not factors:
+        return False
+    product = 1
+    for p, e in factors.items():
+        if not (isinstance(p, int) and isinstance(e, int) and e > 0 and primes.isProbablePrime(p)):
+            return False
+        product *= p**e
+    return product == n - 1
+
+_registry = None
+_registryLock = threading.Lock()
+
+def defaultRegistry():
+    """Returns the registry shared by the whole process, creating it if needed"""
+    global _registry
+    if _registry is None:
+        with _registryLock:
+            if _registry is None:
+                _registry = GroupRegistry(DEFAULT_CACHE_PATH)
+    return _registry
+
+def isValidGroup(g, n):
+    """Checks that g is a primitive root of n using the default registry"""
+    return defaultRegistry().validate(g, n)
@@ -0,0 +1,516 @@
+import errno
+import os
+import queue
+import selectors
+import socket
+import threading
+import time
+import traceback
+import Encrypt
+import chatcore
+import framing
+import metrics
+import tickets
+
+"""Non-blocking key exchange driven by a selector
+
+A Handshaker runs one thread that drives every handshake in flight, both
+outgoing and incoming, as a small state machine over a non-blocking socket.
+A peer that is slow or never answers only holds up its own handshake, which
+fails when its timeout runs out. Outgoing connections are retried with a
+growing delay. A listening socket keeps accepting for as long as it is
+open.
+
+The wire protocol is the same as chatcore's, including ticket resumption,
+and finished handshakes are handed over as blocking chatcore.Connections.
+
+Progress is reported through an onEvent(event, detail) callback, called on
+the Handshaker's thread. It must not block. A UI should queue the events
+and handle them on its own thread. Events are:
+
+    "connecting"  detail is (address, attempt number)
+    "accepted"    detail is the peer's address
+    "retrying"    detail is the error that ended the last attempt
+    "done"        detail is the Connection
+    "failed"      detail is the error
+"""
+
+CONNECT_TIMEOUT = 5.0 #seconds for a TCP connection to be made
+READ_TIMEOUT = 10.0 #seconds for the peer to send or take each handshake frame
+RETRIES = 2 #extra attempts after a failed outgoing handshake
+RETRY_DELAY = 0.5 #seconds before the first retry, doubled after each one
+ACCEPT_BACKLOG = 128 #pending connections, enough that a burst is not held up by SYN retries
+ACCEPT_BACKOFF = 0.1 #seconds a listener pauses after running out of file descriptors
+_RESOURCE_ERRORS = (errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.ENOMEM)
+
+class _Exchange:
+    """One handshake over a non-blocking socket.
+
+    Sends and receives whole frames, then calls the step given for what
+    comes next. Frames are read with exactly sized recv calls, so nothing
+    after the handshake is read by mistake.
+    """
+    def __init__(self, handshaker, onEvent, makeLocksmith, ticketCache):
+        self.handshaker = handshaker
+        #a failing callback must not leave the handshake half done
+        self.onEvent = lambda event, detail: handshaker._safely(onEvent, event, detail)
+        self.makeLocksmith = makeLocksmith
+        self.ticketCache = ticketCache
+        self.soc = None
+        self.deadline = None
+        self._events = 0
+        self._outgoing = None
+        self._afterSend = None
+        self._incoming = bytearray()
+        self._needed = 0
+        self._frameType = None
+        self._afterReceive = None
+
+    def _watch(self, events, timeout):
+        """Waits for events on the socket, for at most timeout seconds"""
+        selector = self.handshaker.selector
+        if self._events == 0:
+            selector.register(self.soc, events, self)
+        elif self._events != events:
+            selector.modify(self.soc, events, self)
+        self._events = events
+        self.deadline = time.monotonic() + timeout
+
+    def _unwatch(self):
+        if self._events:
+            self.handshaker.selector.unregister(self.soc)
+            self._events = 0
+        self.deadline = None
+
+    def send(self, frameType, payload, then):
+        """Sends a frame, then calls then()"""
+        self._outgoing = memoryview(framing.packFrame(frameType, payload))
+        self._afterSend = then
+        self._watch(selectors.EVENT_WRITE, self.handshaker.readTimeout)
+
+    def receive(self, then):
+        """Receives a frame, then calls then(frameType, payload)"""
+        self._incoming = bytearray()
+        self._needed = framing.HEADER.size
+        self._frameType = None
+        self._afterReceive = then
+        self._watch(selectors.EVENT_READ, self.handshaker.readTimeout)
+
+    def handle(self, mask):
+        """Called by the Handshaker when the socket is ready"""
+        if mask & selectors.EVENT_WRITE:
+            self.writable()
+        elif mask & selectors.EVENT_READ:
+            self.readable()
+
+    def writable(self):
+        try:
+            sent = self.soc.send(self._outgoing)
+        except (BlockingIOError, InterruptedError):
+            return
+        self._outgoing = self._outgoing[sent:]
+        if len(self._outgoing) == 0:
+            self._outgoing = None
+            self._afterSend()
+
+    def readable(self):
+        try:
+            data = self.soc.recv(self._needed - len(self._incoming))
+        except (BlockingIOError, InterruptedError):
+            return
+        if not data:
+            raise ConnectionError("Connection closed during handshake")
+        self._incoming += data
+        if len(self._incoming) < self._needed:
+            return
+        if self._frameType is None:
+            length, self._frameType = framing.HEADER.unpack(self._incoming)
+            if length > framing.MAX_FRAME_SIZE:
+                raise ValueError("Frame of " + str(length) + " bytes is larger than " + str(framing.MAX_FRAME_SIZE))
+            self._incoming = bytearray()
+            self._needed = length
+            if length:
+                return
+        self._afterReceive(self._frameType, bytes(self._incoming))
+
+    def finish(self, key, ticket, resumed):
+        """Hands the socket over as a blocking Connection using key"""
+        self._unwatch()
+        soc, self.soc = self.soc, None #the Connection owns it now
+        soc.setblocking(True)
+        connection = chatcore.Connection(soc, Encrypt.Vigenere(chatcore.CHAR_RANGE, key, False), None, ticket, resumed)
+        self.handshaker._forget(self)
+        if metrics.enabled:
+            metrics.increment("handshake.resumed" if resumed else "handshake.completed")
+        self.onEvent("done", connection)
+
+    def timedOut(self):
+        """Called by the Handshaker once the deadline has passed"""
+        self.fail(socket.timeout("Handshake timed out"))
+
+    def fail(self, error):
+        """Closes the socket and reports error"""
+        self.close()
+        self.handshaker._forget(self)
+        if metrics.enabled:
+            metrics.increment("handshake.failed")
+        self.onEvent("failed", error)
+
+    def close(self):
+        if self.soc is not None:
+            self._unwatch()
+            self.soc.close()
+            self.soc = None
+
+    def gotHandshake(self, frameType, payload):
+        """Checks that the frame is a handshake frame and returns its value"""
+        if frameType != framing.FRAME_HANDSHAKE:
+            raise ValueError("Expected a handshake frame, got type " + str(frameType))
+        if len(payload) == 0:
+            raise ValueError("Empty handshake value, it would give an empty key")
+        return str(payload, "utf-8")
+
+class _ClientExchange(_Exchange):
+    """Connecting side: connect, optionally resume, else full handshake"""
+    def __init__(self, handshaker, address, onEvent, makeLocksmith, ticketCache):
+        _Exchange.__init__(self, handshaker, onEvent, makeLocksmith, ticketCache)
+        self.address = address
+        self.attempt = 0
+        self.locksmith = None
+        self.intermediateVal = None
+        self.ticket = None
+        self.clientNonce = None
+        self._resuming = False
+        self._waitingForConnect = False
+        self._retryAt = None
+
+    def start(self):
+        """Starts a connection attempt"""
+        self.attempt += 1
+        self._retryAt = None
+        self.onEvent("connecting", (self.address, self.attempt))
+        self.soc = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.soc.setblocking(False)
+        result = self.soc.connect_ex(self.address)
+        if result not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN):
+            raise OSError(result, os.strerror(result))
+        self._waitingForConnect = True
+        self._watch(selectors.EVENT_WRITE, self.handshaker.connectTimeout)
+
+    def writable(self):
+        if not self._waitingForConnect:
+            return _Exchange.writable(self)
+        self._waitingForConnect = False
+        error = self.soc.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if error:
+            raise OSError(error, os.strerror(error)) #OSError picks the subclass, e.g. ConnectionRefusedError
+        ticket = self.ticketCache.get(self.address) if self.ticketCache is not None else None
+        if ticket is not None:
+            self.ticket = ticket
+            self.clientNonce = tickets.newNonce()
+            self._resuming = True
+            self.send(framing.FRAME_RESUME, ticket.ticketId + self.clientNonce, lambda: self.receive(self.gotResume))
+        else:
+            self.fullHandshake()
+
+    def gotResume(self, frameType, payload):
+        self._resuming = False
+        if frameType != framing.FRAME_RESUME:
+            raise ValueError("Expected a resume frame, got type " + str(frameType))
+        if len(payload) == tickets.NONCE_SIZE:
+            self.finish(tickets.sessionKey(self.ticket, self.clientNonce, payload, chatcore.CHAR_RANGE), self.ticket, True)
+        else:
+            self.ticketCache.discard(self.address)
+            self.fullHandshake()
+
+    def fullHandshake(self):
+        #a new locksmith every time, a value sent on a failed attempt may
+        #have reached someone else and is never sent again
+        self.locksmith, self.intermediateVal = self.makeLocksmith()
+        self.send(framing.FRAME_HANDSHAKE, bytes(self.intermediateVal, "utf-8"), lambda: self.receive(self.gotKey))
+
+    def gotKey(self, frameType, payload):
+        otherKey = self.gotHandshake(frameType, payload)
+        key = self.locksmith.makeKey(otherKey)
+        ticket = tickets.makeTicket(key)
+        if self.ticketCache is not None:
+            self.ticketCache.add(self.address, ticket)
+        self.finish(key, ticket, False)
+
+    def fail(self, error):
+        """Retries network errors after a delay while attempts are left, otherwise reports error
+
+        A failed resume discards the ticket and starts over straight away
+        with a full handshake, without using up an attempt. A peer that
+        hangs up on resume frames would otherwise fail every attempt the
+        same way.
+        """
+        if self._resuming:
+            self._resuming = False
+            self.ticketCache.discard(self.address)
+            self.close()
+            self.onEvent("retrying", error)
+            self.attempt -= 1
+            self._retryAt = self.deadline = time.monotonic()
+            return
+        if self.attempt > self.handshaker.retries or not isinstance(error, OSError):
+            return _Exchange.fail(self, error)
+        self.close()
+        self.onEvent("retrying", error)
+        self._retryAt = time.monotonic() + self.handshaker.retryDelay*2**(self.attempt - 1)
+        self.deadline = self._retryAt
+
+    def timedOut(self):
+        if self._retryAt is not None:
+            self.start()
+        else:
+            _Exchange.timedOut(self)
+
+class _ServerExchange(_Exchange):
+    """Accepting side: answer a resume, else full handshake"""
+    def __init__(self, handshaker, soc, onEvent, makeLocksmith, ticketCache):
+        _Exchange.__init__(self, handshaker, onEvent, makeLocksmith, ticketCache)
+        self.soc = soc
+        soc.setblocking(False)
+
+    def start(self):
+        self.receive(self.gotFirst)
+
+    def gotFirst(self, frameType, payload):
+        if frameType != framing.FRAME_RESUME:
+            return self.gotKey(frameType, payload)
+        ticket = None
+        if self.ticketCache is not None and len(payload) == tickets.TICKET_ID_SIZE + tickets.NONCE_SIZE:
+            ticket = self.ticketCache.get(payload[:tickets.TICKET_ID_SIZE])
+        if ticket is None:
+            self.send(framing.FRAME_RESUME, b"", lambda: self.receive(self.gotKey))
+            return
+        serverNonce = tickets.newNonce()
+        key = tickets.sessionKey(ticket, payload[tickets.TICKET_ID_SIZE:], serverNonce, chatcore.CHAR_RANGE)
+        self.send(framing.FRAME_RESUME, serverNonce, lambda: self.finish(key, ticket, True))
+
+    def gotKey(self, frameType, payload):
+        otherKey = self.gotHandshake(frameType, payload)
+        locksmith, intermediateVal = self.makeLocksmith()
+        key = locksmith.makeKey(otherKey)
+        ticket = tickets.makeTicket(key)
+        if self.ticketCache is not None:
+            self.ticketCache.add(ticket.ticketId, ticket)
+        self.send(framing.FRAME_HANDSHAKE, bytes(intermediateVal, "utf-8"), lambda: self.finish(key, ticket, False))
+
+class _Listener:
+    """Accepts every waiting connection and starts a handshake for each
+
+    Accept errors are reported and the listener carries on. When the process
+    is out of file descriptors or memory it pauses for ACCEPT_BACKOFF
+    seconds, because the waiting connection would make select return again
+    straight away.
+    """
+    def __init__(self, handshaker, soc, onEvent, makeLocksmith, ticketCache):
+        self.handshaker = handshaker
+        self.soc = soc
+        self.onEvent = onEvent
+        self.makeLocksmith = makeLocksmith
+        self.ticketCache = ticketCache
+        self.deadline = None #end of a pause
+        self.registered = False
+
+    def register(self):
+        self.handshaker.selector.register(self.soc, selectors.EVENT_READ, self)
+        self.registered = True
+
+    def unregister(self):
+        if self.registered:
+            self.handshaker.selector.unregister(self.soc)
+            self.registered = False
+
+    def handle(self, mask):
+        while True:
+            try:
+                soc, address = self.soc.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                if e.errno in _RESOURCE_ERRORS:
+                    self.unregister()
+                    self.deadline = time.monotonic() + ACCEPT_BACKOFF
+                    self.fail(e)
+                    return
+                self.fail(e) #e.g. ECONNABORTED, only that connection is lost
+                continue
+            self.handshaker._safely(self.onEvent, "accepted", address)
+            self.handshaker._begin(_ServerExchange(self.handshaker, soc, self.onEvent, self.makeLocksmith, self.ticketCache))
+
+    def timedOut(self):
+        """Ends a pause"""
+        self.deadline = None
+        self.register()
+
+    def fail(self, error):
+        """Reports error. The listener keeps going"""
+        if metrics.enabled:
+            metrics.increment("handshake.acceptErrors")
+        self.handshaker._safely(self.onEvent, "failed", error)
+
+class Handshaker:
+    """Drives non-blocking handshakes on a background thread.
+
+    Attributes:
+        selector(BaseSelector): Selector every socket is registered with
+        connectTimeout(float): Seconds for a TCP connection to be made
+        readTimeout(float): Seconds for each handshake frame to be sent or
+            received
+        retries(int): Extra attempts after a failed outgoing handshake
+        retryDelay(float): Seconds before the first retry, doubled after
+            each one
+
+    """
+    def __init__(self, connectTimeout=CONNECT_TIMEOUT, readTimeout=READ_TIMEOUT, retries=RETRIES, retryDelay=RETRY_DELAY):
+        """Creates the Handshaker and starts its thread.
+
+        Args:
+            connectTimeout(float, optional): see Attributes
+            readTimeout(float, optional): see Attributes
+            retries(int, optional): see Attributes
+            retryDelay(float, optional): see Attributes
+
+        """
+        self.connectTimeout = connectTimeout
+        self.readTimeout = readTimeout
+        self.retries = retries
+        self.retryDelay = retryDelay
+        self.selector = selectors.DefaultSelector()
+        self._exchanges = set()
+        self._listeners = {}
+        self._calls = queue.Queue()
+        self._closed = False
+        self._wakeReader, self._wakeWriter = socket.socketpair()
+        self._wakeReader.setblocking(False)
+        self.selector.register(self._wakeReader, selectors.EVENT_READ, None)
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _call(self, function, *args):
+        """Runs function(*args) on the Handshaker's thread"""
+        self._calls.put((function, args))
+        try:
+            self._wakeWriter.send(b"\0")
+        except OSError:
+            pass
+
+    def _begin(self, exchange):
+        """Starts an exchange. Runs on the Handshaker's thread"""
+        self._exchanges.add(exchange)
+        try:
+            exchange.start()
+        except Exception as e:
+            self._safely(exchange.fail, e)
+
+    def _safely(self, function, *args):
+        """Calls function(*args), printing any exception instead of raising it
+
+        Keeps the loop thread alive when an onEvent callback or a queued
+        call fails, since every handshake depends on it.
+        """
+        try:
+            function(*args)
+        except Exception:
+            traceback.print_exc()
+
+    def _forget(self, exchange):
+        self._exchanges.discard(exchange)
+
+    def connect(self, address, makeLocksmith, onEvent, ticketCache=None):
+        """Starts a handshake with a listening party. Returns immediately.
+
+        Args:
+            address(tuple): String address, int port
+            makeLocksmith(callable): Returns a (locksmith, intermediate
+                value) tuple, like chatcore.newLocksmith. Called on the
+                Handshaker's thread.
+            onEvent(callable): Progress callback, see the module docstring
+            ticketCache(TicketCache, optional): Tickets by address, see
+                chatcore.connect
+
+        """
+        self._call(self._begin, _ClientExchange(self, address, onEvent, makeLocksmith, ticketCache))
+
+    def listen(self, address, makeLocksmith, onEvent, ticketCache=None, backlog=ACCEPT_BACKLOG):
+        """Accepts and handshakes with every party that connects to address.
+
+        Binding happens right away, so a busy address raises OSError here.
+
+        Args:
+            address(tuple): String address, int port
+            makeLocksmith(callable): see connect
+            onEvent(callable): Progress callback for every accepted connection
+            ticketCache(TicketCache, optional): Tickets by id, see
+                chatcore.acceptHandshake
+            backlog(int, optional): listen backlog
+
+        Returns:
+            The listening socket, for stopListening.
+        """
+        listeningSocket = chatcore.listen(address, backlog)
+        listeningSocket.setblocking(False)
+        self._call(self._addListener, _Listener(self, listeningSocket, onEvent, makeLocksmith, ticketCache))
+        return listeningSocket
+
+    def _addListener(self, listener):
+        self._listeners[listener.soc] = listener
+        listener.register()
+
+    def stopListening(self, listeningSocket):
+        """Stops accepting on a socket from listen and closes it"""
+        self._call(self._removeListener, listeningSocket)
+
+    def _removeListener(self, listeningSocket):
+        listener = self._listeners.pop(listeningSocket, None)
+        if listener is not None:
+            listener.unregister()
+        listeningSocket.close()
+
+    def close(self):
+        """Stops the thread, abandoning handshakes and closing listeners"""
+        self._closed = True
+        self._call(lambda: None)
+        self._thread.join()
+
+    def _run(self):
+        while not self._closed:
+            waiting = list(self._exchanges) + list(self._listeners.values())
+            deadlines = [w.deadline for w in waiting if w.deadline is not None]
+            timeout = max(0.0, min(deadlines) - time.monotonic()) if deadlines else None
+            for key, mask in self.selector.select(timeout):
+                if key.data is None:
+                    try:
+                        while self._wakeReader.recv(4096):
+                            pass
+                    except (BlockingIOError, InterruptedError):
+                        pass
+                    continue
+                try:
+                    key.data.handle(mask)
+                except Exception as e:
+                    self._safely(key.data.fail, e)
+            while True:
+                try:
+                    function, args = self._calls.get_nowait()
+                except queue.Empty:
+                    break
+                self._safely(function, *args)
+            now = time.monotonic()
+            waiting = list(self._exchanges) + list(self._listeners.values())
+            for due in [w for w in waiting if w.deadline is not None and w.deadline <= now]:
+                try:
+                    due.timedOut()
+                except Exception as e:
+                    self._safely(due.fail, e)
+        for exchange in list(self._exchanges):
+            exchange.close()
+        for listeningSocket in list(self._listeners):
+            self._removeListener(listeningSocket)
+        self.selector.close()
+        self._wakeReader.close()
+        self._wakeWriter.close()
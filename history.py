@@ -0,0 +1,146 @@
+import collections
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import weakref
+
+"""Bounded chat history with an append-only log for scrollback
+
+Only the most recent messages are kept as strings. Every message is also
+appended to a log, and its offset in the log goes into an index of fixed
+size entries, so message i can be found without reading anything before
+it.
+
+Older messages are read back through memory maps of the log and index
+files, so the memory used stays the same however long the session runs.
+
+The log holds decrypted messages. Its files are only readable by the user,
+and without a path they go in a private directory (mode 0700) that is
+removed on close, or when the process exits if close is never called.
+"""
+
+DEFAULT_CAPACITY = 1000 #messages kept in memory
+OFFSET = struct.Struct("<Q")
+
+def _privateOpener(path, flags):
+    """Opener creating files that only the user can read"""
+    return os.open(path, flags, 0o600)
+
+class ChatHistory:
+    """Recent messages in memory, all messages in an append-only log.
+
+    Attributes:
+        capacity(int): Number of recent messages kept in memory
+        path(str): The log file. Its index is path + ".idx"
+        count(int): Number of messages appended so far
+
+    """
+    def __init__(self, path=None, capacity=DEFAULT_CAPACITY):
+        """Creates the history, continuing an existing log at path.
+
+        Args:
+            path(str, optional): Log file. If not given, the log goes in a
+                private temporary directory, removed on close or at exit.
+            capacity(int, optional): Number of recent messages kept in memory
+
+        """
+        self.capacity = capacity
+        self._removeDirectory = None
+        if path is None:
+            directory = tempfile.mkdtemp(prefix="chat-history-") #only the user can enter it
+            path = os.path.join(directory, "history.log")
+            #also runs at exit, so the transcript never outlives the process
+            self._removeDirectory = weakref.finalize(self, shutil.rmtree, directory, True)
+        self.path = path
+        self._log = open(path, "ab", opener=_privateOpener)
+        self._index = open(path + ".idx", "ab", opener=_privateOpener)
+        self._offset = self._log.tell()
+        self.count = self._index.tell()//OFFSET.size
+        self._recent = collections.deque(maxlen=capacity)
+        self._lock = threading.Lock()
+        self._logMap = None
+        self._indexMap = None
+
+    def append(self, message):
+        """Adds message to the history. Returns its index"""
+        data = message.encode("utf-8")
+        with self._lock:
+            self._index.write(OFFSET.pack(self._offset))
+            self._log.write(data)
+            self._offset += len(data)
+            self._recent.append(message)
+            self.count += 1
+            return self.count - 1
+
+    def recent(self):
+        """Returns the messages kept in memory, oldest first"""
+        with self._lock:
+            return list(self._recent)
+
+    def firstRecent(self):
+        """Returns the index of the oldest message kept in memory"""
+        with self._lock:
+            return self.count - len(self._recent)
+
+    def _maps(self):
+        """Returns up to date (log, index) memory maps, or (None, None) if empty"""
+        self._log.flush()
+        self._index.flush()
+        if self._offset == 0 or self.count == 0:
+            return None, None
+        if self._logMap is None or len(self._logMap) < self._offset or len(self._indexMap) < self.count*OFFSET.size:
+            self._closeMaps()
+            with open(self.path, "rb") as f:
+                self._logMap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            with open(self.path + ".idx", "rb") as f:
+                self._indexMap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._logMap, self._indexMap
+
+    def get(self, start, stop):
+        """Returns messages start to stop-1, reading older ones from the log
+
+        Args:
+            start(int): Index of the first message
+            stop(int): Index after the last message. Clamped to count.
+
+        """
+        with self._lock:
+            stop = min(stop, self.count)
+            start = max(0, start)
+            if start >= stop:
+                return []
+            firstRecent = self.count - len(self._recent)
+            if start >= firstRecent:
+                return list(self._recent)[start - firstRecent:stop - firstRecent]
+            logMap, indexMap = self._maps()
+            if logMap is None:
+                return [""]*(stop - start) #every message so far was empty
+            #message i ends where message i+1 starts, the last one at the
+            #end of the log as it was mapped
+            messages = []
+            for i in range(start, stop):
+                begin = OFFSET.unpack_from(indexMap, i*OFFSET.size)[0]
+                if (i + 1)*OFFSET.size < len(indexMap):
+                    end = OFFSET.unpack_from(indexMap, (i + 1)*OFFSET.size)[0]
+                else:
+                    end = len(logMap)
+                messages.append(logMap[begin:end].decode("utf-8"))
+            return messages
+
+    def _closeMaps(self):
+        if self._logMap is not None:
+            self._logMap.close()
+            self._indexMap.close()
+            self._logMap = self._indexMap = None
+
+    def close(self):
+        """Closes the log, removing it if it was in a temporary directory"""
+        with self._lock:
+            self._closeMaps()
+            self._log.close()
+            self._index.close()
+            if self._removeDirectory is not None:
+                self._removeDirectory()
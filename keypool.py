@@ -0,0 +1,86 @@
+import queue
+import threading
+import Encrypt
+import entropy
+
+"""Pool of ready-made Diffie-Hellman keypairs for fast handshakes"""
+
+DEFAULT_POOL_SIZE = 8
+
+class KeyPool:
+    """Keeps a bounded queue of locksmiths for one (g, n) ready to use.
+
+    A worker thread creates locksmiths with fresh secrets and calls
+    makeIntermediateVal on them ahead of time, so a handshake only has to
+    call makeKey. Every locksmith is handed out once and has already used up
+    its single makeIntermediateVal, so secrets are never reused.
+
+    Attributes:
+        g(int): A primitive root of n
+        n(int): A prime number
+        secretLength(int): Length of VigLocksmith secrets. None makes the
+            pool hold plain Locksmiths with random secret exponents instead.
+        pairs(Queue): Ready (locksmith, intermediate value) tuples.
+
+    """
+    def __init__(self, g, n, size=DEFAULT_POOL_SIZE, secretLength=5, precompute=True):
+        """Creates the pool and starts filling it.
+
+        Args:
+            g(int): A primitive root of n
+            n(int): A prime number
+            size(int, optional): Most pairs kept ready at once.
+            secretLength(int, optional): Length of VigLocksmith secrets, or
+                None for plain Locksmiths.
+            precompute(bool, optional): Passed on to the locksmiths, see
+                Encrypt.Locksmith.
+
+        Raises:
+            ValueError: If g is not a primitive root of n.
+        """
+        self.g = g
+        self.n = n
+        self.secretLength = secretLength
+        self.precompute = precompute
+        self.pairs = queue.Queue(maxsize=size)
+        self._first = self._makePair() #checks the parameters before starting the thread
+        self._stopped = threading.Event()
+        self._worker = threading.Thread(target=self._fill)
+        self._worker.daemon = True
+        self._worker.start()
+
+    def _makePair(self):
+        """Returns a new (locksmith, intermediate value) tuple"""
+        if self.secretLength is None:
+            locksmith = Encrypt.Locksmith(self.g, self.n, entropy.randbelow(self.n-2) + 1, self.precompute)
+        else:
+            locksmith = Encrypt.VigLocksmith(self.g, self.n, Encrypt.genVigKey(self.secretLength), self.precompute)
+        return locksmith, locksmith.makeIntermediateVal()
+
+    def _fill(self):
+        """Keeps the queue topped up until close is called. Runs on the worker thread"""
+        pair = self._first
+        self._first = None
+        while not self._stopped.is_set():
+            if pair is None:
+                pair = self._makePair()
+            try:
+                self.pairs.put(pair, timeout=0.5)
+                pair = None
+            except queue.Full:
+                pass
+
+    def take(self):
+        """Returns a ready (locksmith, intermediate value) tuple.
+
+        Makes one on the spot if the pool has run dry, so callers never wait
+        on the worker thread.
+        """
+        try:
+            return self.pairs.get_nowait()
+        except queue.Empty:
+            return self._makePair()
+
+    def close(self):
+        """Stops the worker thread. Pairs already in the pool can still be taken"""
+        self._stopped.set()
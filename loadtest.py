@@ -0,0 +1,355 @@
+import argparse
+import json
+import sys
+import threading
+import time
+import chatcore
+import keypool
+
+"""Loopback load test for the chat networking
+
+Starts a listener and N simulated peers in this process, all over loopback
+sockets. It uses the same chatcore handshake and Connection code as the Tk
+client's Setup and Chat. Each peer does the VigLocksmith handshake, then
+sends messages at a set rate and size, and the listener echoes every
+message back. Each echo is checked against what was sent.
+
+Reported: connection setup latency percentiles, failed connections,
+message throughput, and messages that were dropped (never echoed),
+garbled (echoed wrong) or out of order.
+
+    python loadtest.py --peers 50 --rate 20 --size 200 --duration 10
+    python loadtest.py --peers 512 --ramp
+
+With --ramp the peer count doubles from 1 up to --peers, one run each, to
+find where a single process stops keeping up.
+"""
+
+PADDING = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
+
+def makeMessage(peer, seq, size):
+    """Returns message seq of peer, padded to size characters
+
+    The content is fixed by peer and seq, so an echo can be checked without
+    remembering what was sent.
+    """
+    head = str(peer) + ":" + str(seq) + ":"
+    if len(head) >= size:
+        return head
+    padding = PADDING[seq % len(PADDING):] + PADDING*(size//len(PADDING) + 1)
+    return head + padding[:size - len(head)]
+
+def parseSeq(message):
+    """Returns the sequence number of a message from makeMessage, or None"""
+    parts = message.split(":", 2)
+    if len(parts) < 3 or not parts[1].isdigit():
+        return None
+    return int(parts[1])
+
+def percentile(values, fraction):
+    """Returns the value below which fraction of values fall, or None if empty"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction*len(ordered)))]
+
+class Listener:
+    """Accepts peers and echoes every message back, one thread per peer.
+
+    Attributes:
+        address(tuple): Address it listens on
+        connections(list): Connections accepted so far
+        errors(int): Handshakes or connections that failed
+
+    """
+    def __init__(self, g, n, backlog, poolSize):
+        """Starts listening on a free loopback port.
+
+        Args:
+            g(int): A primitive root of n
+            n(int): A prime number
+            backlog(int): listen backlog, should be about the peer count
+            poolSize(int): Size of the KeyPool used for handshakes
+
+        """
+        self.g = g
+        self.n = n
+        self.keyPool = keypool.KeyPool(g, n, size=poolSize)
+        self.listeningSocket = chatcore.listen(("127.0.0.1", 0), backlog)
+        self.address = self.listeningSocket.getsockname()
+        self.connections = []
+        self.errors = 0
+        self._closing = False
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._acceptLoop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _acceptLoop(self):
+        while True:
+            try:
+                connection = chatcore.accept(self.listeningSocket, self.g, self.n, None, self.keyPool)
+            except (ConnectionError, ValueError):
+                with self._lock:
+                    self.errors += 1
+                continue
+            except OSError:
+                return #the listening socket was closed
+            with self._lock:
+                self.connections.append(connection)
+            thread = threading.Thread(target=self._echo, args=(connection,))
+            thread.daemon = True
+            thread.start()
+
+    def _echo(self, connection):
+        try:
+            while True:
+                message = connection.receive()
+                if message is None:
+                    break
+                connection.send(message)
+        except (OSError, ValueError):
+            with self._lock:
+                if not self._closing:
+                    self.errors += 1
+        finally:
+            connection.close()
+
+    def close(self):
+        """Stops accepting and closes every connection"""
+        with self._lock:
+            self._closing = True
+        self.listeningSocket.close()
+        self.keyPool.close()
+        with self._lock:
+            for connection in self.connections:
+                connection.close()
+
+class Peer:
+    """One simulated chat client.
+
+    Attributes:
+        setupTime(float): Seconds taken to connect and handshake, None if
+            that failed
+        sent(int): Messages sent
+        received(int): Echoes received
+        garbled(int): Echoes that did not match the message sent
+        outOfOrder(int): Echoes that came back before an earlier message
+        error(str): What went wrong, if anything
+
+    """
+    def __init__(self, peerId, address, g, n, rate, size):
+        """Creates a Peer. Call connect, then run, then finish.
+
+        Args:
+            peerId(int): Number of the peer, part of every message
+            address(tuple): Listener address
+            g(int): A primitive root of n
+            n(int): A prime number
+            rate(float): Messages per second, 0 for as fast as possible
+            size(int): Characters per message
+
+        """
+        self.peerId = peerId
+        self.address = address
+        self.g = g
+        self.n = n
+        self.rate = rate
+        self.size = size
+        self.connection = None
+        self.setupTime = None
+        self.sent = 0
+        self.received = 0
+        self.garbled = 0
+        self.outOfOrder = 0
+        self.error = None
+        self._nextSeq = 0
+        self._receiver = None
+
+    def connect(self):
+        """Connects and handshakes, recording how long it took"""
+        start = time.perf_counter()
+        try:
+            self.connection = chatcore.connect(self.address, self.g, self.n)
+        except (OSError, ValueError) as e:
+            self.error = "connect: " + str(e)
+            return
+        self.setupTime = time.perf_counter() - start
+        self._receiver = threading.Thread(target=self._receive)
+        self._receiver.daemon = True
+        self._receiver.start()
+
+    def _receive(self):
+        try:
+            while True:
+                message = self.connection.receive()
+                if message is None:
+                    return
+                self.received += 1
+                seq = parseSeq(message)
+                if seq is None or message != makeMessage(self.peerId, seq, self.size):
+                    self.garbled += 1
+                    continue
+                if seq != self._nextSeq:
+                    self.outOfOrder += 1
+                self._nextSeq = seq + 1
+        except (OSError, ValueError) as e:
+            if self.error is None:
+                self.error = "receive: " + str(e)
+
+    def run(self, stopAt):
+        """Sends messages at self.rate (as fast as possible if 0) until stopAt"""
+        if self.connection is None:
+            return
+        start = time.perf_counter()
+        try:
+            while True:
+                now = time.perf_counter()
+                if now >= stopAt:
+                    break
+                if self.rate:
+                    due = start + self.sent/self.rate
+                    if due > now:
+                        time.sleep(min(due, stopAt) - now)
+                        continue
+                self.connection.send(makeMessage(self.peerId, self.sent, self.size))
+                self.sent += 1
+        except OSError as e:
+            self.error = "send: " + str(e)
+
+    def finish(self, drainUntil):
+        """Waits for outstanding echoes until drainUntil, then disconnects"""
+        if self.connection is None:
+            return
+        while self.received < self.sent and time.perf_counter() < drainUntil and self._receiver.is_alive():
+            time.sleep(0.01)
+        self.connection.close()
+
+def runLoad(peers, rate, size, duration, g=5, n=23, drain=5.0, connectThreads=32):
+    """Runs one load test and returns its report as a dict
+
+    Args:
+        peers(int): Number of simulated peers
+        rate(float): Messages per second sent by each peer, 0 for as fast as
+            possible
+        size(int): Characters per message
+        duration(float): Seconds spent sending, after every peer connected
+        g(int, optional): A primitive root of n
+        n(int, optional): A prime number
+        drain(float, optional): Seconds to wait for outstanding echoes
+        connectThreads(int, optional): Peers connecting at the same time
+
+    """
+    listener = Listener(g, n, max(128, peers), min(peers, 64))
+    simulated = [Peer(i, listener.address, g, n, rate, size) for i in range(peers)]
+    try:
+        connectStart = time.perf_counter()
+        #connect in waves so the listen backlog is not the only thing measured
+        nextPeer = iter(simulated)
+        lock = threading.Lock()
+        def connectWorker():
+            while True:
+                with lock:
+                    peer = next(nextPeer, None)
+                if peer is None:
+                    return
+                peer.connect()
+        workers = [threading.Thread(target=connectWorker) for i in range(min(connectThreads, peers))]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        connectSeconds = time.perf_counter() - connectStart
+
+        sendStart = time.perf_counter()
+        stopAt = sendStart + duration
+        senders = [threading.Thread(target=peer.run, args=(stopAt,)) for peer in simulated]
+        for sender in senders:
+            sender.daemon = True
+            sender.start()
+        for sender in senders:
+            sender.join()
+        sendSeconds = time.perf_counter() - sendStart
+        drainUntil = time.perf_counter() + drain
+        for peer in simulated:
+            peer.finish(drainUntil)
+        totalSeconds = time.perf_counter() - sendStart
+    finally:
+        listener.close()
+
+    setupTimes = [peer.setupTime for peer in simulated if peer.setupTime is not None]
+    sent = sum(peer.sent for peer in simulated)
+    received = sum(peer.received for peer in simulated)
+    garbled = sum(peer.garbled for peer in simulated)
+    errors = [peer.error for peer in simulated if peer.error is not None]
+    return {"peers": peers, "rate": rate, "size": size, "duration": duration,
+            "connected": len(setupTimes), "failedConnections": peers - len(setupTimes),
+            "connectSeconds": connectSeconds,
+            "setupLatency": {"p50": percentile(setupTimes, 0.5), "p90": percentile(setupTimes, 0.9),
+                             "p99": percentile(setupTimes, 0.99), "max": max(setupTimes) if setupTimes else None},
+            "sent": sent, "received": received,
+            "dropped": sent - received, "garbled": garbled,
+            "outOfOrder": sum(peer.outOfOrder for peer in simulated),
+            "sendRate": sent/sendSeconds if sendSeconds else 0.0,
+            "echoRate": received/totalSeconds if totalSeconds else 0.0,
+            "echoMBPerSecond": received*size/totalSeconds/1e6 if totalSeconds else 0.0,
+            "listenerErrors": listener.errors, "peerErrors": len(errors),
+            "firstErrors": errors[:5]}
+
+def _ms(seconds):
+    return "-" if seconds is None else format(seconds*1000, ".1f") + "ms"
+
+def formatReport(report):
+    """Returns a one line summary of a runLoad report"""
+    latency = report["setupLatency"]
+    return ("peers=" + str(report["peers"]) + " connected=" + str(report["connected"]) +
+            " setup p50=" + _ms(latency["p50"]) + " p90=" + _ms(latency["p90"]) + " p99=" + _ms(latency["p99"]) +
+            " max=" + _ms(latency["max"]) +
+            " sent=" + str(report["sent"]) + " echoed=" + format(report["echoRate"], ".0f") + "msg/s" +
+            " (" + format(report["echoMBPerSecond"], ".2f") + "MB/s)" +
+            " dropped=" + str(report["dropped"]) + " garbled=" + str(report["garbled"]) +
+            " outOfOrder=" + str(report["outOfOrder"]) +
+            " errors=" + str(report["listenerErrors"] + report["peerErrors"]))
+
+def isHealthy(report, maxDropFraction):
+    """Whether every peer connected and almost every message came back intact"""
+    return (report["failedConnections"] == 0 and report["garbled"] == 0 and
+            report["dropped"] <= maxDropFraction*max(1, report["sent"]))
+
+def main(argv=None):
+    """Runs the load test from the command line"""
+    parser = argparse.ArgumentParser(description="Loopback load test with simulated chat peers")
+    parser.add_argument("--peers", type=int, default=10, help="number of simulated peers, the largest with --ramp")
+    parser.add_argument("--rate", type=float, default=10.0, help="messages per second per peer, 0 for as fast as possible")
+    parser.add_argument("--size", type=int, default=100, help="characters per message")
+    parser.add_argument("--duration", type=float, default=5.0, help="seconds spent sending")
+    parser.add_argument("--drain", type=float, default=5.0, help="seconds to wait for outstanding echoes")
+    parser.add_argument("-g", type=int, default=5, help="primitive root of n")
+    parser.add_argument("-n", type=int, default=23, help="prime modulus")
+    parser.add_argument("--ramp", action="store_true", help="double the peers from 1 until --peers or until a run is unhealthy")
+    parser.add_argument("--max-drop", type=float, default=0.001, help="dropped fraction above which --ramp stops")
+    parser.add_argument("--json", action="store_true", help="print reports as JSON lines")
+    args = parser.parse_args(argv)
+
+    counts = [args.peers]
+    if args.ramp:
+        counts = []
+        count = 1
+        while count < args.peers:
+            counts.append(count)
+            count *= 2
+        counts.append(args.peers)
+    healthy = True
+    for count in counts:
+        report = runLoad(count, args.rate, args.size, args.duration, args.g, args.n, args.drain)
+        print(json.dumps(report, sort_keys=True) if args.json else formatReport(report), flush=True)
+        healthy = isHealthy(report, args.max_drop)
+        if not healthy:
+            if args.ramp:
+                print("unhealthy at " + str(count) + " peers", file=sys.stderr)
+            break
+    if not healthy:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
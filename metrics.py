@@ -0,0 +1,214 @@
+import json
+import math
+import os
+import sys
+import threading
+import time
+
+"""Lightweight timing histograms, counters and gauges
+
+Recording is off by default. Instrumented code checks metrics.enabled before
+doing any work, so while it is off the only cost is that check. Turn it on
+at runtime with enable(), or start the process with CHAT_METRICS=1.
+
+Everything recorded can be read with snapshot() or written out periodically
+by an Exporter. Besides the process-wide totals, counters can be kept per
+session (see incrementSession), so a snapshot shows which session stalled.
+"""
+
+enabled = os.environ.get("CHAT_METRICS", "") not in ("", "0")
+
+_lock = threading.Lock()
+_histograms = {}
+_counters = {}
+_gauges = {}
+_sessions = {} #session name -> its counters and lastActivity time
+
+class Histogram:
+    """Distribution of recorded values in power of two buckets.
+
+    Attributes:
+        count(int): Number of values recorded
+        total(float): Sum of the values
+        minimum(float): Smallest value, None before the first one
+        maximum(float): Largest value, None before the first one
+        buckets(dict): Maps e to the number of values v with
+            2**(e-1) <= v < 2**e
+
+    """
+    def __init__(self):
+        """Creates an empty Histogram"""
+        self.count = 0
+        self.total = 0.0
+        self.minimum = None
+        self.maximum = None
+        self.buckets = {}
+
+    def record(self, value):
+        """Adds value to the histogram"""
+        self.count += 1
+        self.total += value
+        if self.minimum is None or value < self.minimum:
+            self.minimum = value
+        if self.maximum is None or value > self.maximum:
+            self.maximum = value
+        bucket = math.frexp(value)[1]
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def toDict(self):
+        """Returns the histogram as plain data"""
+        return {"count": self.count, "total": self.total, "min": self.minimum, "max": self.maximum,
+                "mean": self.total/self.count if self.count else None,
+                "buckets": {str(e): n for e, n in sorted(self.buckets.items())}}
+
+def enable():
+    """Starts recording"""
+    global enabled
+    enabled = True
+
+def disable():
+    """Stops recording. What was recorded so far is kept"""
+    global enabled
+    enabled = False
+
+def observe(name, value):
+    """Records value in the histogram called name"""
+    with _lock:
+        histogram = _histograms.get(name)
+        if histogram is None:
+            histogram = _histograms[name] = Histogram()
+        histogram.record(value)
+
+def increment(name, amount=1):
+    """Adds amount to the counter called name"""
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+def incrementSession(session, name, amount=1):
+    """Adds amount to the counter called name of session, and notes the time
+
+    Args:
+        session(str): Name of the session, e.g. its peer address
+        name(str): Counter name
+        amount(int, optional): Amount to add
+
+    """
+    with _lock:
+        counters = _sessions.get(session)
+        if counters is None:
+            counters = _sessions[session] = {}
+        counters[name] = counters.get(name, 0) + amount
+        counters["lastActivity"] = time.time()
+
+def endSession(session):
+    """Forgets the counters of a session that has closed"""
+    with _lock:
+        _sessions.pop(session, None)
+
+def setGauge(name, value):
+    """Sets the gauge called name to value"""
+    _gauges[name] = value
+
+class _Timer:
+    """Context manager recording how long its block took, in seconds"""
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *excInfo):
+        observe(self.name, time.perf_counter() - self.start)
+
+class _NullTimer:
+    """Context manager that does nothing, used while recording is off"""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *excInfo):
+        pass
+
+_NULL_TIMER = _NullTimer()
+
+def timer(name):
+    """Returns a context manager that records the time its block takes
+
+    For code that is not on a hot path. Hot paths should check enabled and
+    call observe directly.
+    """
+    return _Timer(name) if enabled else _NULL_TIMER
+
+def snapshot():
+    """Returns everything recorded so far as plain data"""
+    with _lock:
+        return {"time": time.time(),
+                "histograms": {name: h.toDict() for name, h in _histograms.items()},
+                "counters": dict(_counters),
+                "gauges": dict(_gauges),
+                "sessions": {name: dict(counters) for name, counters in _sessions.items()}}
+
+def reset():
+    """Forgets everything recorded so far"""
+    with _lock:
+        _histograms.clear()
+        _counters.clear()
+        _gauges.clear()
+        _sessions.clear()
+
+class Exporter:
+    """Writes a snapshot as one JSON line every interval seconds.
+
+    Subclass and override export to send snapshots elsewhere.
+
+    Attributes:
+        fileObj(file): Where snapshots are written, stdout by default
+        interval(float): Seconds between snapshots
+
+    """
+    def __init__(self, fileObj=None, interval=10.0):
+        """Creates an Exporter. Call start to begin exporting.
+
+        Args:
+            fileObj(file, optional): Where snapshots are written, stdout by
+                default
+            interval(float, optional): Seconds between snapshots
+
+        """
+        self.fileObj = fileObj if fileObj is not None else sys.stdout
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def export(self, data):
+        """Writes one snapshot"""
+        self.fileObj.write(json.dumps(data, sort_keys=True) + "\n")
+        self.fileObj.flush()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.export(snapshot())
+
+    def start(self):
+        """Starts exporting on a daemon thread"""
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stops exporting after writing one final snapshot"""
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.export(snapshot())
+
+class FileExporter(Exporter):
+    """Exporter appending JSON lines to a file"""
+    def __init__(self, path, interval=10.0):
+        """Opens path for appending and creates the Exporter"""
+        Exporter.__init__(self, open(path, "a"), interval)
+
+    def stop(self):
+        """Stops exporting and closes the file"""
+        Exporter.stop(self)
+        self.fileObj.close()
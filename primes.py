@@ -1,42 +1,411 @@
 import os
+import math
+import random
+import array
+import bisect
+import itertools
+import threading
+import concurrent.futures
+import entropy
 
 """Functions that have to do with prime number operations"""
 
+SMALL_PRIMES = (2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37, 41, 43, 47, 53, 59, 61, 67, 71, 73, 79, 83, 89, 97)
+
+SEGMENT_SIZE = 1 << 16 #numbers sieved at a time
+CACHE_LIMIT = 1 << 22 #primes below this are remembered between calls
+
+class PrimeSieve:
+    """Incremental segmented Sieve of Eratosthenes.
+
+    Primes are found one segment of SEGMENT_SIZE numbers at a time, using a
+    bytearray with one byte per odd number. Every prime below cacheLimit that
+    has been found is kept in a compact array and reused by later calls.
+    Past cacheLimit segments are sieved on the fly and thrown away, so memory
+    stays bounded no matter how large the queries get.
+
+    Attributes:
+        segmentSize(int): Numbers covered by one segment.
+        cacheLimit(int): Primes below this are kept between calls.
+
+    """
+    def __init__(self, segmentSize=SEGMENT_SIZE, cacheLimit=CACHE_LIMIT):
+        """Creates a PrimeSieve.
+
+        Args:
+            segmentSize(int, optional): Numbers covered by one segment.
+            cacheLimit(int, optional): Primes below this are kept between calls.
+
+        """
+        self.segmentSize = segmentSize
+        self.cacheLimit = max(cacheLimit, 1024)
+        self._lock = threading.Lock()
+        #bootstrap with a plain sieve so that segments always have base primes
+        flags = bytearray([1])*1024
+        flags[0] = flags[1] = 0
+        for p in range(2, 32):
+            if flags[p]:
+                flags[p*p::p] = bytes(len(range(p*p, 1024, p)))
+        self._primes = array.array("Q", itertools.compress(range(1024), flags))
+        self._sievedTo = 1024 #every prime below this is in self._primes
+
+    def _sieveSegment(self, low, high):
+        """Returns the primes in [low, high), low odd and high <= self._sievedTo**2"""
+        count = (high - low + 1)//2
+        flags = bytearray([1])*count #flags[i] is low + 2*i
+        for p in itertools.islice(self._primes, 1, None):
+            if p*p >= high:
+                break
+            start = max(p*p, (low + p - 1)//p*p)
+            if start % 2 == 0:
+                start += p
+            i = (start - low)//2
+            if i < count:
+                flags[i::p] = bytes((count - 1 - i)//p + 1)
+        return itertools.compress(range(low, low + 2*count, 2), flags)
+
+    def _extendCache(self, limit):
+        """Sieves until every prime below min(limit, cacheLimit) is cached"""
+        limit = min(limit, self.cacheLimit)
+        with self._lock:
+            while self._sievedTo < limit:
+                low = self._sievedTo | 1
+                high = min(low + self.segmentSize, self._sievedTo**2, self.cacheLimit)
+                self._primes.extend(self._sieveSegment(low, high))
+                self._sievedTo = high
+
+    def _uncachedPrimes(self, start):
+        """Generator of the primes >= start that are past the cache, in order"""
+        low = max(start, self._sievedTo) | 1
+        while True:
+            if low >= self._sievedTo**2:
+                raise OverflowError("PrimeSieve cannot go past " + str(self._sievedTo**2))
+            high = min(low + self.segmentSize, self._sievedTo**2)
+            yield from self._sieveSegment(low, high)
+            low = high | 1
+
+    def iterPrimes(self, start=2, stop=None):
+        """Generator of the primes in [start, stop), or every prime >= start
+
+        Only the current segment is held in memory past the cache limit.
+
+        Raises:
+            OverflowError: When going past cacheLimit**2, where the cached
+                primes no longer cover the square root.
+        """
+        idx = bisect.bisect_left(self._primes, start)
+        while True:
+            while idx < len(self._primes):
+                p = self._primes[idx]
+                if stop is not None and p >= stop:
+                    return
+                yield p
+                idx += 1
+            if self._sievedTo >= self.cacheLimit:
+                break
+            self._extendCache(self._sievedTo*2)
+        for p in self._uncachedPrimes(start):
+            if stop is not None and p >= stop:
+                return
+            yield p
+
+    def primesBelow(self, n):
+        """Returns a list of all primes below n"""
+        return list(self.iterPrimes(2, n))
+
+    def nextPrime(self, n):
+        """Returns the smallest prime greater than n"""
+        if n + 1 < self.cacheLimit:
+            self._extendCache(n + 2)
+            idx = bisect.bisect_right(self._primes, n)
+            if idx < len(self._primes):
+                return self._primes[idx]
+        if n + 1 >= self._sievedTo**2:
+            #far past what the sieve can reach, test candidates one at a time
+            candidate = n + 1 if n % 2 == 0 else n + 2
+            while not isProbablePrime(candidate):
+                candidate += 2
+            return candidate
+        return next(self._uncachedPrimes(n + 1))
+
+    def nthPrime(self, k):
+        """Returns the kth prime, 1-indexed so nthPrime(1) is 2
+
+        Raises:
+            ValueError: If k is less than 1.
+        """
+        if k < 1:
+            raise ValueError("There is no prime number " + str(k))
+        while k > len(self._primes) and self._sievedTo < self.cacheLimit:
+            self._extendCache(self._sievedTo*2)
+        if k <= len(self._primes):
+            return self._primes[k-1]
+        return next(itertools.islice(self._uncachedPrimes(0), k - len(self._primes) - 1, None))
+
+_sieve = PrimeSieve()
+
 def genPrime(knownPrimes):
     """Takes a list of all sorted known primes and returns the next one"""
 
     if len(knownPrimes) == 0: return 2
-    lastKnownPrime = knownPrimes[-1]
-    if lastKnownPrime == 2: return 3
-    testCase = lastKnownPrime+2
-    while True:
-        foundOne = False
-        for p in knownPrimes:
-            if testCase%p == 0:
-                foundOne = True
-                break
-        if not foundOne:
-            return testCase #Made it through, not divisible by anything
-        testCase += 2
+    return _sieve.nextPrime(knownPrimes[-1])
 
 def findPrime(primeNum):
     """Finds the primeNumth prime"""
-    primes = []
-    while len(primes) < primeNum:
-        primes.append(genPrime(primes))
-    return primes[-1]
-
-def isPrimitiveRoot(g, n):
-    """Checks that g is a primitive root of n"""
-    modResults = set()
-    for i in range(1,n):
-        modResults.add((g**i)%n)
-        if len(modResults) == n-1:
+    return _sieve.nthPrime(primeNum)
+
+def primesBelow(n):
+    """Returns a list of all primes below n"""
+    return _sieve.primesBelow(n)
+
+DETERMINISTIC_LIMIT = 3317044064679887385961981 #the first 13 primes are enough bases below this
+SAFE_PRIME_SIZES = (1024, 2048, 3072) #bit sizes for DH groups
+
+def _randomBelow(n):
+    """Returns a uniformly random integer in [0, n) from the entropy pool"""
+    return entropy.randbelow(n)
+
+def isProbablePrime(n, rounds=20):
+    """Miller-Rabin primality test.
+
+    Below DETERMINISTIC_LIMIT the first 13 primes are used as bases and the
+    answer is exact. Above it rounds random bases are tried, and a composite
+    passes with probability at most 4**-rounds.
+
+    Args:
+        n(int): Number to test
+        rounds(int, optional): Random bases to try for large n
+
+    Returns:
+        False if n is composite, True if n is (probably) prime.
+    """
+    if n < 2:
+        return False
+    for p in SMALL_PRIMES:
+        if n % p == 0:
+            return n == p
+    d = n-1
+    s = 0
+    while d % 2 == 0:
+        d //= 2
+        s += 1
+    if n < DETERMINISTIC_LIMIT:
+        bases = SMALL_PRIMES[:13]
+    else:
+        bases = [2 + _randomBelow(n-3) for i in range(rounds)]
+    for a in bases:
+        x = pow(a, d, n)
+        if x == 1 or x == n-1:
+            continue
+        for i in range(s-1):
+            x = pow(x, 2, n)
+            if x == n-1:
+                break
+        else:
+            return False
+    return True
+
+def _pollardBrent(n):
+    """Returns a non-trivial factor of the odd composite n"""
+    while True:
+        y = random.randrange(1, n)
+        c = random.randrange(1, n)
+        m = 128
+        g = r = q = 1
+        while g == 1:
+            x = y
+            for i in range(r):
+                y = (y*y + c) % n
+            k = 0
+            while k < r and g == 1:
+                ys = y
+                for i in range(min(m, r-k)):
+                    y = (y*y + c) % n
+                    q = q * abs(x-y) % n
+                g = math.gcd(q, n)
+                k += m
+            r *= 2
+        if g == n:
+            g = 1
+            while g == 1:
+                ys = (ys*ys + c) % n
+                g = math.gcd(abs(x-ys), n)
+        if g != n:
+            return g
+
+def factorize(n):
+    """Factors n into primes.
+
+    Uses trial division by small primes, then Pollard-Brent rho. This is fast
+    when n has at most one large prime factor (e.g. n-1 for a safe prime n),
+    but can take very long for products of two large primes.
+
+    Args:
+        n(int): Number to factor, at least 1
+
+    Returns:
+        Dict mapping each prime factor to its exponent.
+    """
+    factors = {}
+    for p in SMALL_PRIMES:
+        while n % p == 0:
+            factors[p] = factors.get(p, 0) + 1
+            n //= p
+    remaining = [n] if n > 1 else []
+    while remaining:
+        m = remaining.pop()
+        if isProbablePrime(m):
+            factors[m] = factors.get(m, 0) + 1
+        else:
+            d = _pollardBrent(m)
+            remaining.extend((d, m//d))
+    return factors
+
+def isPrimitiveRoot(g, n, factors=None):
+    """Checks that g is a primitive root of n
+
+    g is a primitive root of the prime n exactly when g**((n-1)/q) % n != 1
+    for every prime q dividing n-1, which needs only one modular
+    exponentiation per prime factor. If that holds along with
+    g**(n-1) % n == 1, n is also proven prime, so composite n gives False.
+
+    Args:
+        g(int): Candidate primitive root
+        n(int): Modulus, should be prime
+        factors(iterable of int, optional): Prime factors of n-1, if already
+            known. Computed with factorize otherwise.
+
+    Returns:
+        True if g is a primitive root of n, False otherwise.
+    """
+    if n < 2:
+        return False
+    if n == 2:
+        return g % 2 == 1
+    if pow(g, n-1, n) != 1:
+        return False
+    if factors is None:
+        factors = factorize(n-1)
+    for q in factors:
+        if pow(g, (n-1)//q, n) == 1:
+            return False
+    return True
+
+def findPrimitiveRoot(n):
+    """Finds the smallest primitive root of the prime n
+
+    n-1 is factored once and the candidates 2, 3, ... are tested against
+    that factorization.
+
+    Args:
+        n(int): A prime number
+
+    Returns:
+        The smallest primitive root of n.
+
+    Raises:
+        ValueError: If n is not prime.
+    """
+    if not isProbablePrime(n):
+        raise ValueError(str(n) + " is not prime")
+    if n == 2:
+        return 1
+    factors = factorize(n-1)
+    for g in range(2, n):
+        if isPrimitiveRoot(g, n, factors):
+            return g
+
+def _sievesOut(q, smallPrimes):
+    """True if q or 2q+1 has a factor in smallPrimes"""
+    for p in smallPrimes:
+        r = q % p
+        if r == 0 or r == (p-1)//2:
             return True
     return False
 
+def _searchSafePrime(bits, attempts):
+    """Tries up to attempts random candidates for a safe prime of bits bits.
+
+    Runs in worker processes for genSafePrime.
+
+    Returns:
+        The safe prime found or None.
+    """
+    smallPrimes = primesBelow(2000)[1:]
+    for i in range(attempts):
+        #q has bits-1 bits with the top bit set, so 2q+1 has exactly bits bits
+        q = _randomBelow(1 << (bits-2)) | (1 << (bits-2)) | 1
+        if _sievesOut(q, smallPrimes):
+            continue
+        p = 2*q + 1
+        #cheap Fermat checks weed out nearly all composites before Miller-Rabin
+        if pow(2, q-1, q) != 1 or pow(2, p-1, p) != 1:
+            continue
+        if isProbablePrime(q) and isProbablePrime(p):
+            return p
+    return None
+
+def genSafePrime(bits, workers=None, attempts=256):
+    """Generates a random safe prime p = 2q+1 where q is also prime.
+
+    Candidates are searched in batches across a ProcessPoolExecutor, so the
+    search scales with the number of cores. Should be called from under an
+    if __name__ == "__main__" guard on platforms that spawn processes.
+
+    Args:
+        bits(int): Bit size of p, e.g. one of SAFE_PRIME_SIZES
+        workers(int, optional): Number of processes. Defaults to the number
+            of cores. 1 searches in this process.
+        attempts(int, optional): Candidates tried by each batch.
+
+    Returns:
+        A safe prime with exactly bits bits.
+    """
+    if bits < 3:
+        raise ValueError("Safe primes need at least 3 bits")
+    if bits < 16:
+        #too few candidates for random search and the small prime sieve
+        return random.choice([p for p in primesBelow(1 << bits) if p >= 1 << (bits-1) and isProbablePrime(p//2)])
+    if workers == 1:
+        while True:
+            p = _searchSafePrime(bits, attempts)
+            if p is not None:
+                return p
+    workers = workers or os.cpu_count() or 1
+    executor = concurrent.futures.ProcessPoolExecutor(workers)
+    try:
+        #two batches per worker so no process waits for the next submit
+        pending = {executor.submit(_searchSafePrime, bits, attempts) for i in range(workers*2)}
+        while True:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                p = future.result()
+                if p is not None:
+                    return p
+                pending.add(executor.submit(_searchSafePrime, bits, attempts))
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+def genGroup(bits, workers=None):
+    """Generates new Diffie-Hellman parameters.
+
+    Args:
+        bits(int): Bit size of the modulus, e.g. one of SAFE_PRIME_SIZES
+        workers(int, optional): Number of processes for genSafePrime
+
+    Returns:
+        Tuple (g, n) where n is a safe prime and g is its smallest
+        primitive root, ready to be passed to Locksmith.
+    """
+    n = genSafePrime(bits, workers)
+    factors = (2, (n-1)//2)
+    g = 2
+    while not isPrimitiveRoot(g, n, factors):
+        g += 1
+    return g, n
+
 #not sure if this belongs...
 def randomSecret():
-    """returns a number between 0 and 128, inclusive"""
-    return ord(os.urandom(1))//2
+    """returns a number between 0 and 127, inclusive"""
+    return entropy.randbelow(128)
 
@@ -1,18 +1,38 @@
 import tkinter
 import primes
 import threading
-import socket
-import encrypt
+import Encrypt as encrypt
 import queue
+import collections
 import sys
+import os
+import time
+import keypool
+import chatcore
+import metrics
+import tickets
+import history
+import handshake
+
+SECRET_LENGTH = 5 #length of the random secrets from the key pool
+MESSAGE_POLL_INTERVAL = 50 #ms between checks of Chat.messageQueue
+MAX_MESSAGE_BATCH = 1000 #most messages posted to the chat history at once
+HISTORY_PAGE_SIZE = 200 #messages shown per page of the history window
 
 class Application(tkinter.Frame):
-    """Base of the application, can contain a setup window or a chat window"""
-    def __init__(self,master=None):
+    """Base of the application, contains the setup window. Chats open in windows of their own
+
+    Attributes:
+        ticketCache(TicketCache): Resumption tickets, by address for
+            connections made and by ticket id for connections accepted
+    """
+    def __init__(self,master=None, historyDirectory=None):
         tkinter.Frame.__init__(self,master)
+        self.ticketCache = tickets.TicketCache()
+        self.historyDirectory = historyDirectory
         #self.chat = Chat(self)
         #self.chat.grid(row = 0, column = 0)
-        self.setup = Setup(self, ("127.0.0.1",25123))
+        self.setup = Setup(self, chatcore.DEFAULT_ADDRESS)
         self.setup.grid(row = 0, column =0)
 
     
@@ -20,28 +40,33 @@ class Chat(tkinter.Frame):
     """Chat interface. Has a box for chat history and a box/button to send new messages
 
        Attributes:
-           soc (socket): a socket to communicate with other party
-           encrypter(encryption class, optional): must have encrypt and decrypt methods (see encrypt.Vigenere or encrypt.Caesar) 
+           connection (chatcore.Connection): encrypted connection to the other party
            master(tkinter.Frame): the frame within which to embed this frame
            messageQueue(queue): Queue where messages to be put on local ui are
               queued. Does not do networking. Messages should be formatted and
               decrypted before being placed in the message queue as the strings
               coming out of it are simply appended.
+           history(ChatHistory): Every message posted. Only its in-memory
+              window of recent messages is shown in the chat box, older ones
+              are in the history window.
     """
-    def __init__(self, soc, encrypter = None, master=None):
+    def __init__(self, connection, master=None, chatHistory=None):
         """Initializes application window
 
         Args:
-            soc (socket): a socket to communicate with other party
-            encrypter(encryption class, optional): must have encrypt and decrypt methods (see encrypt.Vigenere or encrypt.Caesar) 
+            connection (chatcore.Connection): encrypted connection to the other party
             master(tkinter.Frame, optional): the frame within which to embed this frame
+            chatHistory(ChatHistory, optional): history to post to. A new
+                one in a private temporary directory if not given.
 
         """
         tkinter.Frame.__init__(self,master)
         self.createWidgets()
-        self.soc = soc
-        self.encrypter = encrypter
+        self.connection = connection
         self.messageQueue = queue.Queue()
+        self.history = chatHistory if chatHistory is not None else history.ChatHistory()
+        self.shownLines = collections.deque() #lines of each message in the chat box
+        self.closed = False
         
         self.listenerThread = threading.Thread(target=self.listenForMessages)
         self.listenerThread.daemon = True
@@ -72,38 +97,72 @@ class Chat(tkinter.Frame):
         self.button["command"] = self.sendMessage
         self.button.grid(row = 2, column=2)
 
+        self.historyButton = tkinter.Button(self, text="History", command=self.showHistory)
+        self.historyButton.grid(row = 2, column=3)
+
     #posts own and sends over network    
     def sendMessage(self):
         """Puts a message into the message Queue and also sends it over the network"""
         messageToSend = self.entry.get()
-        if self.encrypter is not None:
-            self.soc.send(bytearray(self.encrypter.encrypt(messageToSend), "utf-8"))
+        self.connection.send(messageToSend)
         self.messageQueue.put("You: " + messageToSend+"\n\n")
         self.entry.delete(0,tkinter.END)
 
     #Have  to run this on main thread.
     #Messages should be in plaintext by this point.
     def postMessages(self):
-        """Reads from the message queue and posts the message
+        """Reads from the message queue and posts the messages
 
         Any formatting (e.g. names, new lines) should be done
         before entering messages into the messageQueue. Also,
         they should be decrypted at this point.
+
+        Everything waiting in the queue (up to MAX_MESSAGE_BATCH) is posted
+        with a single insert, then the next check is scheduled with after(),
+        so an idle window uses no CPU between checks.
         """
-        while True:
+        if self.closed:
+            return
+        if metrics.enabled:
+            metrics.setGauge("chat.messageQueueDepth", self.messageQueue.qsize())
+        messages = []
+        try:
+            while len(messages) < MAX_MESSAGE_BATCH:
+                messages.append(self.messageQueue.get_nowait())
+        except queue.Empty:
+            pass
+        if messages:
+            for message in messages:
+                self.history.append(message)
+                self.shownLines.append(message.count("\n"))
+            #only the history's in-memory window stays in the chat box
+            dropLines = 0
+            while len(self.shownLines) > self.history.capacity:
+                dropLines += self.shownLines.popleft()
             try:
-                self.update()
-                message = self.messageQueue.get(False) 
                 self.text.config(state = tkinter.NORMAL)
-                self.text.insert(tkinter.END,message)
+                self.text.insert(tkinter.END,"".join(messages))
+                if dropLines:
+                    self.text.delete("1.0", str(dropLines + 1) + ".0")
                 self.text.config(state = tkinter.DISABLED)
-            except queue.Empty:
-                pass
-            except: #most other exceptions mean that other client has closed
-                self.soc.close()
-                break
+            except tkinter.TclError: #window has been closed
+                self.close()
+                return
+        #come straight back if the batch was full, there is more waiting
+        self.after(1 if len(messages) == MAX_MESSAGE_BATCH else MESSAGE_POLL_INTERVAL, self.postMessages)
             
     
+    def close(self):
+        """Closes the connection and the history. Posting stops at the next check"""
+        if not self.closed:
+            self.closed = True
+            self.connection.close()
+            self.history.close()
+
+    def showHistory(self):
+        """Opens a window for scrolling back through the whole history"""
+        HistoryWindow(self.history, self)
+
     def keyPress(self, event):
         """Used to monitor for an enter press in the new message box.
 
@@ -119,27 +178,89 @@ class Chat(tkinter.Frame):
            puts into self.messageQueue.
         """
         while True:
-            messageFromOther = self.soc.recv(4096)
-            messageFromOther = str(messageFromOther,"utf-8")
-            if self.encrypter is not None:
-                messageFromOther = self.encrypter.decrypt(messageFromOther)
+            try:
+                messageFromOther = self.connection.receive()
+            except OSError:
+                break #closed by self.close
+            if messageFromOther is None:
+                break
             self.messageQueue.put("Them: " + messageFromOther + "\n\n")
 
             
+class HistoryWindow(tkinter.Toplevel):
+    """Window showing the chat history a page at a time.
+
+    Pages are read from the history's log only when shown, so scrolling back
+    through a long session does not load all of it.
+
+    Attributes:
+        history(ChatHistory): History being shown
+        start(int): Index of the first message on the page
+    """
+    def __init__(self, chatHistory, master=None):
+        """Opens the window on the latest page.
+
+        Args:
+            chatHistory(ChatHistory): History to show
+            master(tkinter widget, optional): Owner of the window
+
+        """
+        tkinter.Toplevel.__init__(self, master)
+        self.wm_title("Chat history")
+        self.history = chatHistory
+        self.text = tkinter.Text(self)
+        self.text.grid(row=0, column=0, columnspan=3)
+        self.earlierButton = tkinter.Button(self, text="Earlier", command=self.earlier)
+        self.earlierButton.grid(row=1, column=0)
+        self.positionLabel = tkinter.Label(self)
+        self.positionLabel.grid(row=1, column=1)
+        self.laterButton = tkinter.Button(self, text="Later", command=self.later)
+        self.laterButton.grid(row=1, column=2)
+        self.showPage(max(0, self.history.count - HISTORY_PAGE_SIZE))
+
+    def showPage(self, start):
+        """Shows HISTORY_PAGE_SIZE messages from index start"""
+        self.start = start
+        messages = self.history.get(start, start + HISTORY_PAGE_SIZE)
+        self.text.config(state=tkinter.NORMAL)
+        self.text.delete("1.0", tkinter.END)
+        self.text.insert(tkinter.END, "".join(messages))
+        self.text.config(state=tkinter.DISABLED)
+        self.positionLabel["text"] = str(start + 1) + "-" + str(start + len(messages)) + " of " + str(self.history.count)
+
+    def earlier(self):
+        """Shows the previous page"""
+        self.showPage(max(0, self.start - HISTORY_PAGE_SIZE))
+
+    def later(self):
+        """Shows the next page, or the latest messages"""
+        self.showPage(max(0, min(self.start + HISTORY_PAGE_SIZE, self.history.count - HISTORY_PAGE_SIZE)))
+
 class Setup(tkinter.Frame):
     """User interface for creating paramters for networked DH Vigenere key exchange
 
+    Key exchanges run on a handshake.Handshaker, so connecting and listening
+    never block the UI. Every connection made or accepted opens its own chat
+    window, and Setup stays open to accept or make more.
+
     Attributes:
-        parent(Application, optional): usually the same as master. Frame within in which the chat window will be embeded.
+        parent(Application, optional): usually the same as master. Owner of the chat windows.
         socketParams(tuple, optional): String address, int port
         master(Tkinter.Frame, optional): The Frame within which this is embedded.
+        handshaker(Handshaker): Runs the key exchanges
+        events(queue): Progress events from the handshaker, handled on the
+            main thread by pollEvents
+        chats(list): Chat frames opened so far
+        historyDirectory(str): Where chat logs are kept, or None for a
+            private temporary directory per chat, removed when it closes
+        usedSecrets(set): Typed secrets already used for a connection
     """
     #socketParams is a tuple of (addr, port) 
     def __init__(self, parent = None, socketParams=None, master=None):
-        """Creates a Setup frame.
+        """Creates a Setup frame and starts listening on socketParams.
 
         Args:
-            parent(Application, optional): usually the same as master. Frame within in which the chat window will be embeded.
+            parent(Application, optional): usually the same as master. Owner of the chat windows.
             socketParams(tuple, optional): String address, int port
             master(Tkinter.Frame, optional): The Frame within which this is embedded.
         
@@ -148,35 +269,42 @@ class Setup(tkinter.Frame):
         self.createWidgets()
         self.parent = parent
         self.socketParams = socketParams
-        self.listeningSocket = socket.socket()
-        self.listenerThread = threading.Thread(target=self.listenForConnections)
-        self.listenerThread.setDaemon(True)
-        self.listenerThread.start()
+        self.keyPool = keypool.KeyPool(int(self.encryptionParams.gBox.get()), int(self.encryptionParams.nBox.get()), secretLength=SECRET_LENGTH)
+        self.params = self.readParams()
+        self.events = queue.Queue()
+        self.chats = []
+        self.closed = False
+        self.historyDirectory = parent.historyDirectory if parent is not None else None
+        self.usedSecrets = set()
+        self._secretLock = threading.Lock() #takeLocksmith runs on the handshaker's thread
+        self.handshaker = handshake.Handshaker()
+        self.listeningSocket = None
+        if self.socketParams is not None:
+            try:
+                self.listeningSocket = self.handshaker.listen(self.socketParams, self.listenerLocksmith, self.onEvent, self.ticketCache())
+                self.showStatus("Listening on " + self.socketParams[0] + ":" + str(self.socketParams[1]))
+            except OSError as e:
+                self.showStatus("Not listening: " + str(e))
+        self.pollEvents()
         
     def connectClicked(self):
-        """Exchanges key with other party, changes UI to chat"""
-        if self.parent is not None:
-            
-            soc = socket.socket()
-            print("Address:"+self.urlBox.get().split(":")[0])
-            print("Port: " + str(int(self.urlBox.get().split(":")[1])))
-            soc.connect((self.urlBox.get().split(":")[0], int(self.urlBox.get().split(":")[1])))
-            self.listeningSocket.close()
-            secretKey = self.encryptionParams.secretBox.get()
-            
-            locksmith = encrypt.VigLocksmith(int(self.encryptionParams.gBox.get()), int(self.encryptionParams.nBox.get()),secretKey) 
+        """Starts a key exchange with the other party and returns straight away
 
-            
-            soc.send(bytearray(locksmith.makeIntermediateVal(), "utf-8"))
-            otherKey = str(soc.recv(4096), "utf-8")
-            print("KEY FROM OTHER: "+otherKey)
-            finalKey = locksmith.makeKey(otherKey)
-            print("FINAL KEY: "+finalKey)
-            vi = encrypt.Vigenere((65,122), finalKey, False)
-            
-            self.parent.setup.grid_forget()
-            self.parent.chat = Chat(soc, encrypter=vi, master=self.parent)
+        Progress shows in the status line, and a chat window opens once the
+        exchange is done.
+        """
+        if self.parent is not None:
+            try:
+                address = chatcore.parseAddress(self.urlBox.get())
+                params = self.readParams()
+            except ValueError as e:
+                self.showStatus("Invalid connection details: " + str(e))
+                return
+            self.handshaker.connect(address, lambda: self.takeLocksmith(*params), self.onEvent, self.ticketCache())
 
+    def ticketCache(self):
+        """Returns the Application's TicketCache, or None without one"""
+        return self.parent.ticketCache if self.parent is not None else None
 
     def createWidgets(self):
         """Lays out setup UI"""
@@ -196,33 +324,119 @@ class Setup(tkinter.Frame):
         self.connectButton = tkinter.Button(self, text="Connect", command = self.connectClicked)
         self.connectButton.grid(row=3, column=1, sticky = tkinter.E)
 
-    def listenForConnections(self):
-        """Listens for connections from another party.
+        self.statusLabel = tkinter.Label(self, text="", anchor=tkinter.W)
+        self.statusLabel.grid(row=4, column=0, columnspan=2, sticky = tkinter.E+tkinter.W)
+
+    def showStatus(self, text):
+        """Shows text in the status line"""
+        self.statusLabel["text"] = text
+
+    #Runs on the handshaker's thread, so it only queues the event.
+    def onEvent(self, event, detail):
+        """Queues a progress event from the handshaker for pollEvents"""
+        self.events.put((event, detail))
 
-           Upon connection exchanges keys and sets up chat window.
+    #Have to run this on main thread.
+    def pollEvents(self):
+        """Handles queued handshake events, then checks again with after()
+
+        Also keeps self.params up to date with the entered values, since the
+        handshaker's thread must not read the Tk entries itself. The next
+        check is scheduled even if handling an event raises, so one bad
+        event cannot stop the rest from being shown.
         """
-        print("listening for connections")
-        if self.socketParams is not None:
+        try:
+            try:
+                self.params = self.readParams()
+            except ValueError:
+                pass #half typed, keep the last valid values
+            while True:
+                event, detail = self.events.get_nowait()
+                self.handleEvent(event, detail)
+        except queue.Empty:
+            pass
+        except tkinter.TclError: #window has been closed
+            self.close()
+        finally:
+            if not self.closed:
+                self.after(MESSAGE_POLL_INTERVAL, self.pollEvents)
+
+    def close(self):
+        """Stops handshaking and closes every chat, with its connection and history"""
+        if not self.closed:
+            self.closed = True
+            self.handshaker.close()
+            self.keyPool.close()
+            for chat in self.chats:
+                chat.close()
+            self.chats = []
+
+    def handleEvent(self, event, detail):
+        """Shows a handshake event and opens a chat window for a finished one"""
+        if event == "connecting":
+            address, attempt = detail
+            self.showStatus("Connecting to " + address[0] + ":" + str(address[1]) + (" (attempt " + str(attempt) + ")" if attempt > 1 else ""))
+        elif event == "accepted":
+            self.showStatus("Exchanging keys with " + detail[0] + ":" + str(detail[1]))
+        elif event == "retrying":
+            self.showStatus("Retrying after: " + str(detail))
+        elif event == "failed":
+            self.showStatus("Key exchange failed: " + str(detail))
+        elif event == "done":
             try:
-                self.listeningSocket.bind(self.socketParams)
-                self.listeningSocket.listen(5)
-                cliSoc, p = self.listeningSocket.accept()
-                secretStr = self.encryptionParams.secretBox.get()
-                locksmith = encrypt.VigLocksmith(int(self.encryptionParams.gBox.get()), int(self.encryptionParams.nBox.get()), secretStr)
-                
-                recKey = str(cliSoc.recv(4096), "utf-8")
-                print("Key from other: " +recKey)
-                vi = encrypt.Vigenere((65,122), locksmith.makeKey(recKey), False)
-
-                cliSoc.send(bytearray(locksmith.makeIntermediateVal(),"utf-8"))
-                
-                self.grid_forget()
-                self.parent.chat = Chat(cliSoc, encrypter = vi, master=self.parent)
+                peer = detail.soc.getpeername()
             except OSError:
-                #print("OS ERROR")
-                raise #We will close the socket from elsewhere which will cause exception
-            except:
-                raise
+                detail.close()
+                self.showStatus("The other party left right after the key exchange")
+                return
+            self.showStatus("Connected to " + peer[0] + ":" + str(peer[1]) + (" (resumed)" if detail.resumed else ""))
+            self.openChat(detail, peer)
+
+    def openChat(self, connection, peer):
+        """Opens a chat window for connection"""
+        window = tkinter.Toplevel(self.parent)
+        window.wm_title("Chat with " + peer[0] + ":" + str(peer[1]))
+        chatHistory = None
+        if self.historyDirectory is not None:
+            name = "chat-" + peer[0] + "-" + str(peer[1]) + "-" + time.strftime("%Y%m%d-%H%M%S") + ".log"
+            chatHistory = history.ChatHistory(os.path.join(self.historyDirectory, name))
+        chat = Chat(connection, master=window, chatHistory=chatHistory)
+        self.chats.append(chat)
+        def closed():
+            chat.close()
+            self.chats.remove(chat)
+            window.destroy()
+        window.protocol("WM_DELETE_WINDOW", closed)
+
+    def readParams(self):
+        """Returns the entered (g, n, secret). Raises ValueError if g or n is not a number"""
+        return int(self.encryptionParams.gBox.get()), int(self.encryptionParams.nBox.get()), self.encryptionParams.secretBox.get()
+
+    def listenerLocksmith(self):
+        """Returns a locksmith pair for an accepted connection. Called on the handshaker's thread"""
+        return self.takeLocksmith(*self.params)
+
+    def takeLocksmith(self, g, n, secretStr):
+        """Returns a (locksmith, intermediate value) tuple for the given parameters.
+
+           A blank secret means a fresh random one, which comes from
+           self.keyPool when g and n match it. Otherwise the locksmith is made
+           from the given values. A typed secret is used for one connection
+           only, made or accepted, since every connection using it would
+           share its intermediate value.
+
+           Raises:
+               ValueError: If secretStr was typed and has already been used.
+        """
+        if secretStr == "" and (g, n) == (self.keyPool.g, self.keyPool.n):
+            return self.keyPool.take()
+        if secretStr != "":
+            with self._secretLock:
+                if secretStr in self.usedSecrets:
+                    raise ValueError("The typed secret has already been used, type a new one or clear it for random secrets")
+                self.usedSecrets.add(secretStr)
+        locksmith = encrypt.VigLocksmith(g, n, secretStr if secretStr != "" else encrypt.genVigKey(SECRET_LENGTH))
+        return locksmith, locksmith.makeIntermediateVal()
 
     def keyPress(self, event):
         """Key press listener for address textbox.
@@ -239,7 +453,9 @@ class EncryptionParams(tkinter.Frame):
     Attributes:
         nBox(Entry): Value of n
         gBox(Entry): Value of g
-        secretBox(Entry): Value of initial secret key
+        secretBox(Entry): Value of initial secret key. Starts out blank,
+            which gives every connection a fresh random secret. A typed
+            secret is good for one connection.
     """
     def __init__(self, master=None):
         """Creates EncryptionParams UI"""
@@ -266,16 +482,30 @@ class EncryptionParams(tkinter.Frame):
         self.gBox.grid(row=3, column=1)
         self.gBox.insert(0, "5")
 
-        self.secretLabel = tkinter.Label(self, text="Secret Number:")
+        self.secretLabel = tkinter.Label(self, text="Secret (blank for random):")
         self.secretLabel.grid(row=4, column=0)
 
         self.secretBox = tkinter.Entry(self)
         self.secretBox.grid(row=4, column=1)
-        self.secretBox.insert(0, encrypt.genVigKey(5)) 
 
-        
-root = tkinter.Tk()
-root.wm_title("Chat client")
-app = Application(master=root)
-app.grid(row=0, column=0)
-app.mainloop()
+
+def main(historyDirectory=None):
+    """Opens the chat client window and runs it until it is closed
+
+    Args:
+        historyDirectory(str, optional): Directory to keep chat logs in.
+            Without it each chat's log is removed when the chat closes.
+
+    """
+    root = tkinter.Tk()
+    root.wm_title("Chat client")
+    app = Application(master=root, historyDirectory=historyDirectory)
+    app.grid(row=0, column=0)
+    try:
+        app.mainloop()
+    finally:
+        #the chat windows go with the main one, close what they left open
+        app.setup.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+import codecs
+import mmap
+import os
+
+"""Streaming encryption/decryption with Encrypt.Caesar or Encrypt.Vigenere
+
+Input is processed in chunks. The position in the key is carried from one
+chunk to the next, so the output is the same as encrypting everything in one
+call no matter where the input is split.
+"""
+
+DEFAULT_CHUNK_SIZE = 1 << 20
+
+class CipherStream:
+    """Encrypts or decrypts input handed to it piece by piece.
+
+    Attributes:
+        cipher(Caesar or Vigenere): Cipher used to process the chunks.
+        decrypt(bool): If true, chunks are decrypted instead of encrypted.
+        position(int): Number of characters processed so far.
+
+    """
+    def __init__(self, cipher, decrypt=False):
+        """Creates a CipherStream.
+
+        Args:
+            cipher(Caesar or Vigenere): Cipher used to process the chunks.
+            decrypt(bool): If true, chunks are decrypted. Default is false
+
+        """
+        self.cipher = cipher
+        self.decrypt = decrypt
+        self.position = 0
+
+    def process(self, chunk):
+        """Processes the next chunk of input.
+
+        Args:
+            chunk(str or bytes): Input following whatever was processed before.
+
+        Returns:
+            The processed chunk, same type as chunk.
+        """
+        output = self.cipher.encrypt(chunk, self.decrypt, self.position)
+        self.position += len(chunk)
+        return output
+
+def processChunks(cipher, chunks, decrypt=False):
+    """Generator which encrypts or decrypts an iterable of chunks.
+
+    Args:
+        cipher(Caesar or Vigenere): Cipher used to process the chunks.
+        chunks(iterable of str or bytes): Consecutive pieces of the input.
+        decrypt(bool): If true, chunks are decrypted. Default is false
+
+    Yields:
+        The processed chunks, in order.
+    """
+    stream = CipherStream(cipher, decrypt)
+    for chunk in chunks:
+        yield stream.process(chunk)
+
+class CipherWriter:
+    """File-like wrapper that processes everything written to it.
+
+    Works over text or binary files, as long as what is written matches the
+    mode of the wrapped file.
+
+    Attributes:
+        fileObj(file): File that processed data is written to.
+        stream(CipherStream): Keeps track of the key position.
+
+    """
+    def __init__(self, cipher, fileObj, decrypt=False):
+        """Creates a CipherWriter.
+
+        Args:
+            cipher(Caesar or Vigenere): Cipher used to process the data.
+            fileObj(file): File that processed data is written to.
+            decrypt(bool): If true, data is decrypted. Default is false
+
+        """
+        self.fileObj = fileObj
+        self.stream = CipherStream(cipher, decrypt)
+
+    def write(self, data):
+        """Processes data and writes it to the wrapped file. Returns len(data)"""
+        self.fileObj.write(self.stream.process(data))
+        return len(data)
+
+    def flush(self):
+        """Flushes the wrapped file"""
+        self.fileObj.flush()
+
+    def close(self):
+        """Closes the wrapped file"""
+        self.fileObj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *excInfo):
+        self.close()
+
+class CipherReader:
+    """File-like wrapper that processes everything read from it.
+
+    Attributes:
+        fileObj(file): File that data is read from.
+        stream(CipherStream): Keeps track of the key position.
+
+    """
+    def __init__(self, cipher, fileObj, decrypt=False):
+        """Creates a CipherReader.
+
+        Args:
+            cipher(Caesar or Vigenere): Cipher used to process the data.
+            fileObj(file): File that data is read from.
+            decrypt(bool): If true, data is decrypted. Default is false
+
+        """
+        self.fileObj = fileObj
+        self.stream = CipherStream(cipher, decrypt)
+
+    def read(self, size=-1):
+        """Reads up to size characters (everything if negative) and processes them"""
+        return self.stream.process(self.fileObj.read(size))
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(DEFAULT_CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+    def close(self):
+        """Closes the wrapped file"""
+        self.fileObj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *excInfo):
+        self.close()
+
+def processFile(cipher, srcPath, dstPath, decrypt=False, encoding="utf-8", chunkSize=DEFAULT_CHUNK_SIZE):
+    """Encrypts or decrypts a file in constant memory.
+
+    The source file is memory-mapped and handled chunkSize bytes at a time.
+    With an encoding the file is processed as text, giving the same result
+    as encrypting the whole decoded file in one call. With encoding None the
+    raw bytes are processed (charRange must then be within 0-255).
+
+    Args:
+        cipher(Caesar or Vigenere): Cipher used to process the file.
+        srcPath(str): File to read.
+        dstPath(str): File to write the result to.
+        decrypt(bool): If true, the file is decrypted. Default is false
+        encoding(str, optional): Text encoding of both files. Default utf-8
+        chunkSize(int): Number of bytes read from the source at a time.
+
+    """
+    stream = CipherStream(cipher, decrypt)
+    if encoding is not None:
+        decoder = codecs.getincrementaldecoder(encoding)()
+        encoder = codecs.getincrementalencoder(encoding)()
+    with open(srcPath, "rb") as src, open(dstPath, "wb") as dst:
+        size = os.fstat(src.fileno()).st_size
+        if size == 0:
+            return
+        with mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            for start in range(0, size, chunkSize):
+                chunk = mapped[start:start+chunkSize]
+                if encoding is None:
+                    dst.write(stream.process(chunk))
+                else:
+                    text = decoder.decode(chunk, start+chunkSize >= size)
+                    dst.write(encoder.encode(stream.process(text)))
+            if encoding is not None:
+                dst.write(encoder.encode("", True))
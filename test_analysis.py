@@ -0,0 +1,12 @@
+import Encrypt
+import analysis
+
+def test_keyLengthShortInput():
+    for ciphertext in ("", "A", "Xq", "ABCDEFGHIJ"):
+        assert analysis.keyLength(ciphertext) == 1
+
+def test_breakVigenereShortInput():
+    ciphertext = Encrypt.Vigenere((65,122), "KEY", False).encrypt("Hi")
+    key, plaintext = analysis.breakVigenere(ciphertext)
+    assert len(key) == 1
+    assert len(plaintext) == len(ciphertext)
@@ -0,0 +1,119 @@
+import collections
+import hashlib
+import threading
+import time
+import Encrypt
+import entropy
+
+"""Session resumption tickets
+
+After a full Diffie-Hellman handshake both parties turn the agreed key into
+a master secret and a ticket id with makeTicket, without sending anything
+more. To reconnect, the client sends the ticket id and a fresh nonce, the
+server answers with its own nonce, and both derive a new session key from
+the master secret and the two nonces with sessionKey. No exponentiation is
+needed, and every resumed session gets a different key.
+
+Tickets expire after their lifetime. The server keeps them in a bounded
+TicketCache keyed by ticket id, the client keeps them keyed by the address
+of the server.
+"""
+
+TICKET_LIFETIME = 3600.0 #seconds a ticket can be used for
+TICKET_CACHE_SIZE = 1024 #tickets kept before the least recently used is evicted
+TICKET_ID_SIZE = 16
+NONCE_SIZE = 16
+
+Ticket = collections.namedtuple("Ticket", ["ticketId", "masterSecret", "keyLength", "expires"])
+Ticket.__doc__ = """A resumable session.
+
+    Attributes:
+        ticketId(bytes): Names the ticket on the wire
+        masterSecret(bytes): Secret resumed session keys are derived from
+        keyLength(int): Length of resumed session keys
+        expires(float): time.time() after which the ticket is refused
+    """
+
+def makeTicket(key, lifetime=TICKET_LIFETIME):
+    """Returns the Ticket both parties derive from a handshake's key
+
+    Args:
+        key(str): Vigenere key agreed by the handshake
+        lifetime(float, optional): Seconds the ticket can be used for
+
+    """
+    keyBytes = bytes(key, "utf-8")
+    masterSecret = hashlib.sha256(b"dhchat master secret" + keyBytes).digest()
+    ticketId = hashlib.sha256(b"dhchat ticket id" + keyBytes).digest()[:TICKET_ID_SIZE]
+    return Ticket(ticketId, masterSecret, len(key), time.time() + lifetime)
+
+def newNonce():
+    """Returns NONCE_SIZE random bytes"""
+    return entropy.randomBytes(NONCE_SIZE)
+
+def sessionKey(ticket, clientNonce, serverNonce, charRange=(65,122)):
+    """Derives the Vigenere key of a resumed session
+
+    Args:
+        ticket(Ticket): Ticket being resumed
+        clientNonce(bytes): Nonce sent by the connecting party
+        serverNonce(bytes): Nonce sent by the listening party
+        charRange(tuple of 2 ints, optional): Range of key characters
+
+    Returns:
+        A key string of length ticket.keyLength.
+    """
+    return Encrypt.expandKey(ticket.masterSecret + clientNonce + serverNonce, ticket.keyLength, charRange, b"resume")
+
+class TicketCache:
+    """Bounded LRU of unexpired tickets.
+
+    Attributes:
+        maxSize(int): Tickets kept before the least recently used is evicted
+
+    """
+    def __init__(self, maxSize=TICKET_CACHE_SIZE):
+        """Creates an empty TicketCache.
+
+        Args:
+            maxSize(int, optional): Tickets kept before evicting
+
+        """
+        self.maxSize = maxSize
+        self._tickets = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, name, ticket):
+        """Stores ticket under name, replacing any ticket already there"""
+        with self._lock:
+            self._tickets[name] = ticket
+            self._tickets.move_to_end(name)
+            while len(self._tickets) > self.maxSize:
+                self._tickets.popitem(last=False)
+
+    def get(self, name):
+        """Returns the ticket stored under name, or None if there is none or it has expired"""
+        with self._lock:
+            ticket = self._tickets.get(name)
+            if ticket is None:
+                return None
+            if ticket.expires <= time.time():
+                del self._tickets[name]
+                return None
+            self._tickets.move_to_end(name)
+            return ticket
+
+    def discard(self, name):
+        """Removes the ticket stored under name, if any"""
+        with self._lock:
+            self._tickets.pop(name, None)
+
+    def purge(self):
+        """Removes every expired ticket"""
+        now = time.time()
+        with self._lock:
+            for name in [name for name, ticket in self._tickets.items() if ticket.expires <= now]:
+                del self._tickets[name]
+
+    def __len__(self):
+        return len(self._tickets)